@@ -1,44 +1,214 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
 import logging
-from typing import Dict, List, Any
-from ansible.parsing.dataloader import DataLoader
-from ansible.inventory.manager import InventoryManager
+import os
+import re
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Callable, Dict, List, Any, Mapping, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+SNAPSHOT_VERSION = 3
+# Värdvariabler som autopatch läser (effektiva, inkl. group_vars); bara dessa sparas i snapshoten
+SNAPSHOT_VARS = ("ansible_host", "autopatch", "freeipa_managed",
+                 "autopatch_min_available", "autopatch_max_unavailable")
+EMPTY_VARS: Mapping[str, Any] = MappingProxyType({})
+# Inventory-skript och plugin-konfigurationer (plugin: i YAML) ändras inte när deras data
+# gör det; deras fingerprint (och därmed snapshot-cachen) löper ut efter så här många sekunder
+DYNAMIC_INVENTORY_TTL = float(os.environ.get("AUTOPATCH_DYNAMIC_INVENTORY_TTL", 300))
+_PLUGIN_RE = re.compile(rb'^\s*"?plugin"?\s*:\s*\S', re.MULTILINE)
+
+
+@dataclass(frozen=True)
+class InventoryIndex:
+    """Oföränderligt uppslagsindex som byggs en gång per laddning; säkert att läsa från flera trådar."""
+    hosts: Tuple[str, ...]
+    host_vars: Mapping[str, Mapping[str, Any]]
+    groups: Mapping[str, Tuple[str, ...]]
+    clusters: Mapping[str, Tuple[str, ...]]
+    host_cluster: Mapping[str, str]
+    standalone: Tuple[str, ...]
+
+    @classmethod
+    def from_snapshot(cls, snap: Dict[str, Any]) -> "InventoryIndex":
+        groups = {g: tuple(hosts) for g, hosts in snap["groups"].items()}
+        clusters = {g: tuple(sorted(hosts)) for g, hosts in groups.items() if g.endswith("_cluster")}
+        host_cluster: Dict[str, str] = {}
+        for cname, members in clusters.items():
+            for h in members:
+                host_cluster.setdefault(h, cname)
+        hosts = tuple(snap["hosts"])
+        return cls(
+            hosts=hosts,
+            host_vars=MappingProxyType({h: MappingProxyType(dict(v)) for h, v in snap["host_vars"].items()}),
+            groups=MappingProxyType(groups),
+            clusters=MappingProxyType(clusters),
+            host_cluster=MappingProxyType(host_cluster),
+            standalone=tuple(sorted(h for h in hosts if h not in host_cluster)),
+        )
+
+
+def default_cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.environ.get("AUTOPATCH_CACHE_DIR") or os.path.join(base, "autopatch")
+
+
+def inventory_sources(path: str) -> List[str]:
+    """Alla filer ansible läser för inventoryt: källan själv plus group_vars/host_vars bredvid."""
+    roots = [path]
+    if os.path.isfile(path):
+        parent = os.path.dirname(path)
+        roots += [os.path.join(parent, "group_vars"), os.path.join(parent, "host_vars")]
+    files: List[str] = []
+    for root in roots:
+        if os.path.isfile(root):
+            files.append(root)
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            files.extend(os.path.join(dirpath, f) for f in sorted(filenames))
+    return files
+
+
+def is_dynamic_source(path: str) -> bool:
+    """Körbar fil (inventory-skript) eller YAML/JSON med plugin: (inventory-plugin), som ansible tolkar dem."""
+    if not os.path.isfile(path):
+        return False
+    if os.access(path, os.X_OK):
+        return True
+    if path.endswith((".yml", ".yaml", ".json")):
+        try:
+            with open(path, "rb") as f:
+                return bool(_PLUGIN_RE.search(f.read(65536)))
+        except OSError:
+            return False
+    return False
+
+
+def _has_dynamic_source(path: str) -> bool:
+    if os.path.isfile(path):
+        return is_dynamic_source(path)
+    for dirpath, dirnames, filenames in os.walk(path):
+        # group_vars/host_vars i en inventory-katalog är variabler, inte källor
+        dirnames[:] = [d for d in dirnames if d not in ("group_vars", "host_vars")]
+        if any(is_dynamic_source(os.path.join(dirpath, f)) for f in filenames):
+            return True
+    return False
+
+
+def inventory_fingerprint(path: str) -> str:
+    h = hashlib.sha256()
+    for f in inventory_sources(path):
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        h.update(f"{f}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8", "surrogateescape"))
+    if _has_dynamic_source(path):
+        ttl = DYNAMIC_INVENTORY_TTL
+        epoch = int(time.time() // ttl) if ttl > 0 else time.time_ns()
+        h.update(f"dynamic\0{epoch}\n".encode())
+    return h.hexdigest()
+
+
 class AnsibleInventory:
-    def __init__(self, env="qa", base_path="../../../Ansible/environments"):
+    def __init__(self, env="qa", base_path="../../../Ansible/environments",
+                 cache_dir: Optional[str] = None, use_cache: bool = True,
+                 loader_factory: Optional[Callable[[], Any]] = None):
         self.env = env
         self.path = f"{base_path}/{env}/inventory"
-        self.loader = DataLoader()
-        self.inventory = InventoryManager(loader=self.loader, sources=[self.path])
-        logger.info(f"Laddade inventory från {self.path}")
+        self.fingerprint = inventory_fingerprint(self.path)
+        self.loader = None
+        self._loader_factory = loader_factory
+        self._inventory = None
+        self.cache_file = os.path.join(
+            cache_dir or default_cache_dir(),
+            f"inventory_{hashlib.sha1(os.path.abspath(self.path).encode()).hexdigest()[:16]}.json",
+        )
+
+        snap = self._load_snapshot(self.fingerprint) if use_cache else None
+        if snap is None:
+            snap = self._build_snapshot(self.fingerprint)
+            if use_cache:
+                self._save_snapshot(snap)
+            logger.info(f"Laddade inventory från {self.path}")
+        else:
+            logger.info(f"Laddade inventory från {self.path} (cache {self.cache_file})")
+        self.index = InventoryIndex.from_snapshot(snap)
+
+    @property
+    def inventory(self):
+        """Fullt InventoryManager-objekt; byggs först när det behövs."""
+        if self._inventory is None:
+            from ansible.parsing.dataloader import DataLoader
+            from ansible.inventory.manager import InventoryManager
+
+            if self.loader is None:
+                self.loader = self._loader_factory() if self._loader_factory else DataLoader()
+            self._inventory = InventoryManager(loader=self.loader, sources=[self.path])
+        return self._inventory
+
+    def _build_snapshot(self, fingerprint: str) -> Dict[str, Any]:
+        from ansible.vars.manager import VariableManager
+
+        inv = self.inventory
+        hosts = list(inv.hosts.keys())
+        groups = {gname: [h.name for h in grp.get_hosts()] for gname, grp in inv.groups.items()}
+        # Effektiva variabler (host + grupp + group_vars/host_vars) löses i ett svep
+        vm = VariableManager(loader=self.loader, inventory=inv)
+        host_vars = {}
+        for name, host in inv.hosts.items():
+            all_vars = vm.get_vars(host=host, include_hostvars=False)
+            host_vars[name] = {k: all_vars[k] for k in SNAPSHOT_VARS if k in all_vars}
+        return {
+            "version": SNAPSHOT_VERSION,
+            "fingerprint": fingerprint,
+            "path": os.path.abspath(self.path),
+            "hosts": hosts,
+            "groups": groups,
+            "host_vars": host_vars,
+        }
+
+    def _load_snapshot(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if snap.get("version") != SNAPSHOT_VERSION or snap.get("fingerprint") != fingerprint:
+            logger.debug(f"Inventory-cache {self.cache_file} är inaktuell")
+            return None
+        return snap
+
+    def _save_snapshot(self, snap: Dict[str, Any]) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            tmp = f"{self.cache_file}.tmp.{os.getpid()}"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(snap, f, ensure_ascii=False, separators=(",", ":"), default=str)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            logger.warning(f"Kunde inte skriva inventory-cache {self.cache_file}: {e}")
 
     def get_all_hosts(self) -> List[str]:
-        return list(self.inventory.hosts.keys())
+        return list(self.index.hosts)
 
-    def get_host_vars(self, hostname: str) -> Dict[str, Any]:
-        host = self.inventory.get_host(hostname)
-        return host.vars if host else {}
+    def get_host_vars(self, hostname: str) -> Mapping[str, Any]:
+        return self.index.host_vars.get(hostname, EMPTY_VARS)
 
     def hosts_in_group(self, group: str) -> List[str]:
-        g = self.inventory.groups.get(group)
-        if not g:
-            return []
-        return [h.name for h in g.get_hosts()]
+        return list(self.index.groups.get(group, ()))
 
     def cluster_groups(self) -> Dict[str, List[str]]:
-        out: Dict[str, List[str]] = {}
-        for gname, grp in self.inventory.groups.items():
-            if gname.endswith("_cluster"):
-                out[gname] = [h.name for h in grp.get_hosts()]
-        return {k: sorted(v) for k, v in out.items()}
+        return {k: list(v) for k, v in self.index.clusters.items()}
+
+    def cluster_of(self, hostname: str) -> Optional[str]:
+        return self.index.host_cluster.get(hostname)
 
     def standalone_hosts(self) -> List[str]:
-        all_hosts = set(self.get_all_hosts())
-        cluster_members = set()
-        for hosts in self.cluster_groups().values():
-            cluster_members.update(hosts)
-        return sorted(all_hosts - cluster_members)
+        return list(self.index.standalone)
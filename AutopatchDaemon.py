@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import itertools
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from Metrics import OPENMETRICS_CONTENT_TYPE, PROMETHEUS_CONTENT_TYPE
+
+log = logging.getLogger(__name__)
+
+JOB_TYPES = ("run", "probe")
+MAX_FINISHED_JOBS = 200
+
+
+@dataclass
+class Job:
+    id: str
+    type: str
+    env: str
+    params: Dict[str, Any] = field(default_factory=dict)
+    status: str = "queued"     # "queued" | "running" | "done" | "failed"
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+
+    @property
+    def dedup_key(self) -> Tuple[str, str, str]:
+        # probe-timeout och probe_timeout är samma parameter (som i main.job_args)
+        params = {k.replace("-", "_"): v for k, v in self.params.items()}
+        return self.type, self.env, json.dumps(params, sort_keys=True)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class AutopatchDaemon:
+    """
+    Långlivad jobbkö för autopatch. Tar emot run/probe-jobb som JSON över HTTP
+    (TCP eller unix-socket) och kör dem ett i taget via runner(job).
+
+    Ett jobb med samma typ, miljö och parametrar som ett köat eller pågående
+    jobb slås ihop med det befintliga i stället för att köas igen.
+    """
+
+    def __init__(self, runner: Callable[[Job], Dict[str, Any]], listen: str,
+                 validate: Optional[Callable[[Job], Any]] = None,
+                 render: Optional[Callable[..., str]] = None,
+                 metrics: Optional[Callable[[bool], str]] = None):
+        self.runner = runner
+        self.listen = listen
+        self.validate = validate
+        # render(run_id, env=...) -> sökväg till xlsx; används av GET /reports/<run_id>/xlsx
+        self.render = render
+        # metrics(openmetrics) -> text; används av GET /metrics
+        self.metrics = metrics
+        self._jobs: Dict[str, Job] = {}
+        self._order: List[str] = []
+        self._queue: "queue.Queue[Job]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+        self._server = None
+
+    def submit(self, spec: Dict[str, Any]) -> Tuple[Job, bool]:
+        if not isinstance(spec, dict):
+            raise ValueError("jobbet måste vara ett JSON-objekt")
+        job_type = spec.get("type", "run")
+        if job_type not in JOB_TYPES:
+            raise ValueError(f"okänd jobbtyp: {job_type}")
+        env = spec.get("env")
+        if not env or not isinstance(env, str):
+            raise ValueError("env saknas")
+        params = {k: v for k, v in spec.items() if k not in ("type", "env")}
+
+        job = Job(id=f"{datetime.now():%Y%m%d-%H%M%S}-{next(self._seq)}", type=job_type, env=env, params=params)
+        if self.validate:
+            self.validate(job)
+
+        with self._lock:
+            for other_id in self._order:
+                other = self._jobs[other_id]
+                if other.status in ("queued", "running") and other.dedup_key == job.dedup_key:
+                    log.info(f"Jobb {job_type} env={env} finns redan som {other.id}")
+                    return other, False
+            self._jobs[job.id] = job
+            self._order.append(job.id)
+            self._prune()
+        self._queue.put(job)
+        log.info(f"Köade jobb {job.id} type={job_type} env={env} params={params}")
+        return job, True
+
+    def _prune(self) -> None:
+        finished = [j for j in self._order if self._jobs[j].status in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            self._order.remove(job_id)
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> List[Job]:
+        with self._lock:
+            return [self._jobs[j] for j in self._order]
+
+    def queue_size(self) -> int:
+        return self._queue.qsize()
+
+    def _worker(self) -> None:
+        while True:
+            job = self._queue.get()
+            job.status, job.started = "running", time.time()
+            log.info(f"Startar jobb {job.id} ({job.type} env={job.env})")
+            try:
+                job.result = self.runner(job)
+                job.status = "done"
+            except Exception as e:
+                log.exception(f"Jobb {job.id} misslyckades: {e}")
+                job.status, job.error = "failed", str(e)
+            finally:
+                job.finished = time.time()
+                self._queue.task_done()
+            log.info(f"Jobb {job.id} -> {job.status} ({job.finished - job.started:.1f}s)")
+
+    def _make_server(self):
+        handler = _make_handler(self)
+        if self.listen.startswith("unix:"):
+            path = self.listen[len("unix:"):]
+            if os.path.exists(path):
+                os.unlink(path)
+            server = _UnixHTTPServer(path, handler)
+            os.chmod(path, 0o660)
+            return server
+        host, _, port = self.listen.rpartition(":")
+        return ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+
+    def serve_forever(self) -> None:
+        threading.Thread(target=self._worker, name="autopatch-worker", daemon=True).start()
+        self._server = self._make_server()
+        log.info(f"Autopatch daemon lyssnar på {self.listen}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if self.listen.startswith("unix:"):
+                try:
+                    os.unlink(self.listen[len("unix:"):])
+                except OSError:
+                    pass
+
+    def shutdown(self) -> None:
+        if self._server:
+            self._server.shutdown()
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _make_handler(daemon: AutopatchDaemon):
+    class Handler(BaseHTTPRequestHandler):
+        server_version = "autopatch"
+
+        def address_string(self):
+            return self.client_address[0] if self.client_address else "unix"
+
+        def log_message(self, fmt, *args):
+            log.debug("%s - %s", self.address_string(), fmt % args)
+
+        def _send(self, code: int, payload: Any, content_type: str = "application/json") -> None:
+            body = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_report(self, run_id: str, query: Dict[str, List[str]]) -> None:
+            if not daemon.render:
+                self._send(404, {"error": "rapportrendering är inte aktiverad"})
+                return
+            try:
+                path = daemon.render(run_id, env=(query.get("env") or [None])[0])
+            except FileNotFoundError as e:
+                self._send(404, {"error": str(e)})
+                return
+            except ValueError as e:
+                self._send(400, {"error": str(e)})
+                return
+            with open(path, "rb") as f:
+                body = f.read()
+            self._send(200, body, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+        def _send_metrics(self) -> None:
+            if not daemon.metrics:
+                self._send(404, {"error": "metrics är inte aktiverat"})
+                return
+            # OpenMetrics när skrapan ber om det, annars Prometheus textformat
+            openmetrics = "application/openmetrics-text" in (self.headers.get("Accept") or "")
+            body = daemon.metrics(openmetrics).encode("utf-8")
+            self._send(200, body, OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            path = url.path.rstrip("/")
+            if path == "/health":
+                self._send(200, {"status": "ok", "queue": daemon.queue_size()})
+            elif path == "/jobs":
+                self._send(200, {"jobs": [j.to_dict() for j in daemon.jobs()]})
+            elif path.startswith("/jobs/"):
+                job = daemon.get(path[len("/jobs/"):])
+                if job:
+                    self._send(200, {"job": job.to_dict()})
+                else:
+                    self._send(404, {"error": "okänt jobb"})
+            elif path == "/metrics":
+                self._send_metrics()
+            elif path.startswith("/reports/") and path.endswith("/xlsx"):
+                self._send_report(path[len("/reports/"):-len("/xlsx")], parse_qs(url.query))
+            else:
+                self._send(404, {"error": "okänd sökväg"})
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/jobs":
+                self._send(404, {"error": "okänd sökväg"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                spec = json.loads(self.rfile.read(length) or b"{}")
+                job, created = daemon.submit(spec)
+            except (ValueError, TypeError) as e:
+                self._send(400, {"error": str(e)})
+                return
+            self._send(202 if created else 200, {"job": job.to_dict(), "deduplicated": not created})
+
+    return Handler
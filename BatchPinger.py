@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import select
+import shutil
+import socket
+import struct
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+log = logging.getLogger(__name__)
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def _echo_packet(ident: int, seq: int) -> bytes:
+    payload = b"autopatch"
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = _checksum(header + payload)
+    return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, csum, ident, seq) + payload
+
+
+class BatchPinger:
+    """
+    Pingar en hel lista adresser från en process mot en gemensam deadline.
+
+    Försöker i tur och ordning:
+      1. ICMP datagram-socket (oprivilegierad ping, kräver net.ipv4.ping_group_range)
+      2. en enda fping-process för alla adresser
+      3. vanlig ping per adress i en liten trådpool
+    """
+
+    def __init__(self, timeout: float = 3.0, retries: int = 1, fallback_workers: int = 32):
+        self.timeout = timeout
+        self.retries = max(0, int(retries))
+        self.fallback_workers = max(1, int(fallback_workers))
+
+    def ping_many(self, targets: Iterable[str]) -> Dict[str, bool]:
+        targets = list(dict.fromkeys(targets))
+        if not targets:
+            return {}
+        try:
+            return self._ping_icmp(targets)
+        except OSError as e:
+            log.debug(f"ICMP datagram socket ej tillgänglig ({e}), provar fping")
+        if shutil.which("fping"):
+            try:
+                return self._ping_fping(targets)
+            except (OSError, subprocess.SubprocessError) as e:
+                log.debug(f"fping misslyckades ({e}), faller tillbaka på ping per värd")
+        return self._ping_each(targets)
+
+    def _resolve(self, targets: List[str]) -> Dict[str, Optional[str]]:
+        out: Dict[str, Optional[str]] = {}
+        for t in targets:
+            try:
+                out[t] = socket.gethostbyname(t)
+            except OSError as e:
+                log.debug(f"kunde inte slå upp {t}: {e}")
+                out[t] = None
+        return out
+
+    def _ping_icmp(self, targets: List[str]) -> Dict[str, bool]:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        try:
+            sock.setblocking(False)
+            addrs = self._resolve(targets)
+            pending = {a for a in addrs.values() if a}
+            alive = set()
+            ident = os.getpid() & 0xFFFF
+            deadline = time.monotonic() + self.timeout
+            attempts = self.retries + 1
+            interval = self.timeout / attempts
+            next_send = time.monotonic()
+            seq = 0
+
+            while pending and time.monotonic() < deadline:
+                now = time.monotonic()
+                if attempts and now >= next_send:
+                    for addr in sorted(pending):
+                        seq = (seq + 1) & 0xFFFF
+                        self._send(sock, _echo_packet(ident, seq), addr)
+                    attempts -= 1
+                    next_send = now + interval
+
+                wait = max(0.0, min(deadline, next_send if attempts else deadline) - time.monotonic())
+                readable, _, _ = select.select([sock], [], [], wait)
+                if not readable:
+                    continue
+                while True:
+                    try:
+                        data, (src, _) = sock.recvfrom(1024)
+                    except BlockingIOError:
+                        break
+                    if data and data[0] >> 4 == 4:
+                        data = data[(data[0] & 0x0F) * 4:]
+                    if data and data[0] == ICMP_ECHO_REPLY and src in pending:
+                        pending.discard(src)
+                        alive.add(src)
+
+            return {t: addrs[t] in alive for t in targets}
+        finally:
+            sock.close()
+
+    def _send(self, sock: socket.socket, packet: bytes, addr: str) -> None:
+        while True:
+            try:
+                sock.sendto(packet, (addr, 0))
+                return
+            except BlockingIOError:
+                select.select([], [sock], [], self.timeout)
+            except OSError as e:
+                log.debug(f"ICMP sendto {addr} -> {e}")
+                return
+
+    def _ping_fping(self, targets: List[str]) -> Dict[str, bool]:
+        per_try_ms = max(50, int(self.timeout * 1000 / (self.retries + 1)))
+        cmd = ["fping", "-a", "-q", "-r", str(self.retries), "-t", str(per_try_ms)] + targets
+        res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True, timeout=self.timeout * (self.retries + 2) + 5)
+        alive = {line.strip() for line in res.stdout.splitlines() if line.strip()}
+        return {t: t in alive for t in targets}
+
+    def _ping_each(self, targets: List[str]) -> Dict[str, bool]:
+        wait = str(max(1, int(round(self.timeout))))
+
+        def one(t: str) -> bool:
+            try:
+                rc = subprocess.call(["ping", "-c", "1", "-W", wait, t],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError:
+                return False
+            return rc == 0
+
+        with ThreadPoolExecutor(max_workers=min(self.fallback_workers, len(targets))) as ex:
+            return dict(zip(targets, ex.map(one, targets)))
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import heapq
 import logging
+import math
+import threading
+import time
 from dataclasses import dataclass
 from collections import defaultdict
-from typing import List, Dict, Any, Tuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Any, Callable, Optional, Tuple, Union
 
 log = logging.getLogger(__name__)
 
@@ -16,6 +21,9 @@ class HostOutcome:
     duration: float = 0.0
     user: str = ""
     failed_hosts: List[str] = None
+    task_timings: List[Dict[str, Any]] = None
+    # Väggtid för hela ansible-körningen med --standalone-batch; duration är då värdens egen tid
+    batch_duration: Optional[float] = None
 
 @dataclass
 class ClusterOutcome:
@@ -25,10 +33,36 @@ class ClusterOutcome:
     duration_total: float = 0.0
     failed_hosts: List[str] = None
     batch_results: List[Tuple[str, float, List[str]]] = None
+    task_timings: Dict[str, List[Dict[str, Any]]] = None
+
+def _member_count(value: Any, total: int, round_up: bool) -> Optional[int]:
+    """Tolkar autopatch_min_available/max_unavailable: heltal eller procent av klustret ("50%")."""
+    if value is None or value == "":
+        return None
+    text = str(value).strip()
+    if text.endswith("%"):
+        exact = total * float(text[:-1]) / 100.0
+        return int(math.ceil(exact) if round_up else math.floor(exact))
+    return int(text)
+
 
 class Helper:
-    def __init__(self, playbook_executor):
+    def __init__(self, playbook_executor,
+                 on_outcome: Optional[Callable[[Union[HostOutcome, ClusterOutcome]], None]] = None,
+                 health_probe: Optional[Callable[[Dict[str, Any]], Any]] = None,
+                 health_timeout: float = 300.0, health_interval: float = 5.0):
         self.pb = playbook_executor
+        # Anropas när ett standalone- eller klusterutfall är klart (t.ex. för körjournalen)
+        self.on_outcome = on_outcome
+        # health_probe(row) -> ProbeResult; hälsokontroll av en våg innan nästa startar
+        self.health_probe = health_probe
+        self.health_timeout = health_timeout
+        self.health_interval = health_interval
+
+    def _done(self, outcome):
+        if self.on_outcome:
+            self.on_outcome(outcome)
+        return outcome
 
     def _probe_reason(self, row: Dict[str, Any]) -> str:
         r = row["result"]
@@ -43,8 +77,66 @@ class Helper:
     def _targets_from_rows(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         return [d for d in rows if d["autopatch_enabled"]]
 
-    def run_standalone(self, rows: List[Dict[str, Any]], dry_run: bool) -> List[HostOutcome]:
-        out: List[HostOutcome] = []
+    def plan_waves(self, cluster_name: str, rows: List[Dict[str, Any]],
+                   targets: List[Dict[str, Any]]) -> Tuple[List[List[Dict[str, Any]]], str]:
+        """
+        Delar upp targets i vågor så att minst autopatch_min_available (och högst
+        autopatch_max_unavailable borta) av klustrets alla medlemmar är uppe under
+        patchningen. Inställningarna läses ur medlemmarnas inventory-vars (i praktiken
+        group_vars för klustret); vid olika värden används det strängaste. Utan
+        inställningar blir det en enda våg som tidigare. Medlemmar vars probe
+        misslyckades räknas som redan nere.
+        Returnerar (vågor, "") eller ([], anledning) om ingen värd får tas ner eller
+        om en inställning inte går att tolka.
+        """
+        total = len(rows)
+        allowed = None
+        for d in rows:
+            try:
+                min_available = _member_count(d["vars"].get("autopatch_min_available"), total, round_up=True)
+                max_unavailable = _member_count(d["vars"].get("autopatch_max_unavailable"), total, round_up=False)
+            except ValueError:
+                why = (f"ogiltig autopatch_min_available/max_unavailable för {d['host']}: "
+                       f"{d['vars'].get('autopatch_min_available')!r}/{d['vars'].get('autopatch_max_unavailable')!r} "
+                       f"(heltal eller procent, t.ex. 1 eller \"50%\")")
+                log.warning(f"cluster {cluster_name}: {why}")
+                return [], why
+            for limit in (None if min_available is None else total - min_available, max_unavailable):
+                if limit is not None:
+                    allowed = limit if allowed is None else min(allowed, limit)
+
+        if allowed is None:
+            return [targets], ""
+        down = [d["result"].host for d in rows if self._probe_reason(d)]
+        allowed -= len(down)
+        if allowed <= 0:
+            extra = f", redan nere: {','.join(down)}" if down else ""
+            return [], f"min_available/max_unavailable tillåter ingen medlem nere ({total} medlemmar{extra})"
+        waves = [targets[i:i + allowed] for i in range(0, len(targets), allowed)]
+        log.info(f"cluster {cluster_name}: {len(targets)} av {total} medlemmar i {len(waves)} vågor "
+                 f"(högst {allowed} nere samtidigt, {len(down)} redan nere)")
+        return waves, ""
+
+    def _health_gate(self, rows: List[Dict[str, Any]]) -> List[Tuple[str, str]]:
+        """Probar vågens värdar tills alla är friska eller health_timeout gått ut; returnerar ohälsosamma."""
+        deadline = time.monotonic() + self.health_timeout
+        pending = list(rows)
+        while True:
+            bad = []
+            for d in pending:
+                reason = self._probe_reason({"result": self.health_probe(d)})
+                if reason:
+                    bad.append((d, reason))
+            if not bad or time.monotonic() >= deadline:
+                return [(d["result"].host, why) for d, why in bad]
+            pending = [d for d, _ in bad]
+            log.debug(f"health gate väntar på {','.join(d['result'].host for d in pending)}")
+            time.sleep(self.health_interval)
+
+    def run_standalone(self, rows: List[Dict[str, Any]], dry_run: bool,
+                       batch: bool = False, forks: Optional[int] = None) -> List[HostOutcome]:
+        out: List[Optional[HostOutcome]] = []
+        pending: List[Tuple[int, Dict[str, Any]]] = []
         playbook = self.pb.get_playbook("standalone")
 
         for d in rows:
@@ -54,29 +146,86 @@ class Helper:
 
             if not d["autopatch_enabled"]:
                 log.info(f"SKIP standalone {host}: autopatch=False")
-                out.append(HostOutcome(host=host, status="SKIPPED", reason="autopatch=False", user=user))
+                out.append(self._done(HostOutcome(host=host, status="SKIPPED", reason="autopatch=False", user=user)))
                 continue
 
             probe_fail = self._probe_reason(d)
             if probe_fail:
                 log.info(f"SKIP standalone {host}: {probe_fail}")
-                out.append(HostOutcome(host=host, status="SKIPPED", reason=probe_fail, user=user))
+                out.append(self._done(HostOutcome(host=host, status="SKIPPED", reason=probe_fail, user=user)))
                 continue
 
-            ok, duration, failed_hosts = self.pb.run(playbook, [host], user, pw, dry_run=dry_run)
+            if batch:
+                pending.append((len(out), d))
+                out.append(None)
+                continue
+
+            res = self.pb.run_detailed(playbook, [host], user, pw, dry_run=dry_run)
+            ok, duration, failed_hosts = res.as_tuple()
+            timings = res.host_tasks.get(host, [])
             if ok and not failed_hosts:
                 log.info(f"OK standalone {host} ({duration:.1f}s)")
-                out.append(HostOutcome(host=host, status="OK", reason="patch ok", duration=duration, user=user))
+                out.append(self._done(HostOutcome(host=host, status="OK", reason="patch ok", duration=duration,
+                                                  user=user, task_timings=timings)))
             else:
                 log.warning(f"FAILED standalone {host} ({duration:.1f}s) failed_hosts={failed_hosts}")
-                out.append(HostOutcome(
+                out.append(self._done(HostOutcome(
                     host=host, status="FAILED",
                     reason="playbook failed", duration=duration, user=user,
-                    failed_hosts=failed_hosts or []
-                ))
+                    failed_hosts=failed_hosts or [], task_timings=timings
+                )))
 
+        if pending:
+            for idx, outcome in self._run_standalone_batches(playbook, pending, dry_run, forks):
+                out[idx] = outcome
         return out
 
+    def _run_standalone_batches(self, playbook: str, pending: List[Tuple[int, Dict[str, Any]]],
+                                dry_run: bool, forks: Optional[int]) -> List[Tuple[int, HostOutcome]]:
+        """En ansible-playbook-körning per (user, password); resultatet mappas tillbaka per värd."""
+        batches = defaultdict(list)
+        for idx, d in pending:
+            batches[(d["user"], d["password"])].append((idx, d["result"].host))
+
+        results: List[Tuple[int, HostOutcome]] = []
+        for (user, pw), items in batches.items():
+            hostlist = [h for _, h in items]
+            res = self.pb.run_detailed(playbook, hostlist, user, pw, dry_run=dry_run, forks=forks)
+            ok, duration, failed_hosts = res.as_tuple()
+            failed = set(failed_hosts or []) & set(hostlist)
+            # rc != 0 utan tolkningsbara värdar går inte att attribuera: alla räknas som FAILED
+            unattributed = (not ok) and not failed
+            # Vid rc != 0 är en värd klar bara om callbacken såg den nå playens sista task;
+            # annars kan playen ha avbrutits (any_errors_fatal, max_fail_percentage, ERROR!)
+            finished = set(res.finished_hosts or [])
+            log.info(f"standalone batch user={user} hosts={len(hostlist)} ok={ok} dur={duration:.1f}s "
+                     f"failed_hosts={','.join(sorted(failed))}")
+            for idx, host in items:
+                tasks = res.host_tasks.get(host, [])
+                # Värdens egen tid (summan av dess tasks) när callbacken gav den, annars hela batchens
+                host_duration = sum(t["duration"] for t in tasks) if tasks else duration
+                if host in failed or unattributed:
+                    log.warning(f"FAILED standalone {host} ({host_duration:.1f}s, batch {duration:.1f}s)")
+                    results.append((idx, self._done(HostOutcome(
+                        host=host, status="FAILED", reason="playbook failed",
+                        duration=host_duration, user=user, failed_hosts=[host],
+                        task_timings=tasks, batch_duration=duration
+                    ))))
+                elif not ok and host not in finished:
+                    log.warning(f"FAILED standalone {host}: batchen avbröts innan värden var klar "
+                                f"({host_duration:.1f}s, batch {duration:.1f}s)")
+                    results.append((idx, self._done(HostOutcome(
+                        host=host, status="FAILED", reason="batch aborted",
+                        duration=host_duration, user=user, failed_hosts=[host],
+                        task_timings=tasks, batch_duration=duration
+                    ))))
+                else:
+                    log.info(f"OK standalone {host} ({host_duration:.1f}s, batch {duration:.1f}s)")
+                    results.append((idx, self._done(HostOutcome(host=host, status="OK", reason="patch ok",
+                                                                duration=host_duration, user=user,
+                                                                task_timings=tasks, batch_duration=duration))))
+        return results
+
     def run_cluster(self, cluster_name: str, rows: List[Dict[str, Any]], dry_run: bool) -> ClusterOutcome:
         probe_problems = []
         for d in rows:
@@ -98,34 +247,225 @@ class Helper:
             return ClusterOutcome(cluster=cluster_name, status="SKIPPED", reason="no autopatch=True members",
                                   failed_hosts=[], batch_results=[])
 
-        playbook = self.pb.get_playbook(cluster_name)
-        batches = defaultdict(list)
-        for d in targets:
-            batches[(d["user"], d["password"])].append(d["result"].host)
+        waves, why = self.plan_waves(cluster_name, rows, targets)
+        if not waves:
+            log.info(f"SKIP cluster {cluster_name}: {why}")
+            return ClusterOutcome(cluster=cluster_name, status="SKIPPED", reason=why,
+                                  failed_hosts=[], batch_results=[])
 
+        playbook = self.pb.get_playbook(cluster_name)
         any_failed = False
+        gate_reason = ""
         all_failed_hosts: List[str] = []
         batch_results: List[Tuple[str, float, List[str]]] = []
+        task_timings: Dict[str, List[Dict[str, Any]]] = {}
         duration_total = 0.0
 
-        for (user, pw), hostlist in batches.items():
-            ok, duration, failed_hosts = self.pb.run(playbook, hostlist, user, pw, dry_run=dry_run)
-            duration_total += duration
-            batch_results.append((user, duration, failed_hosts))
-            if (not ok) or failed_hosts:
-                any_failed = True
-                all_failed_hosts.extend(failed_hosts or [])
-                log.warning(f"FAILED cluster {cluster_name} batch user={user} dur={duration:.1f}s hosts={','.join(hostlist)} "
-                            f"failed_hosts={','.join(failed_hosts) if failed_hosts else ''}")
-            else:
-                log.info(f"OK cluster {cluster_name} batch user={user} dur={duration:.1f}s hosts={','.join(hostlist)}")
+        for wave_no, wave in enumerate(waves, 1):
+            batches = defaultdict(list)
+            for d in wave:
+                batches[(d["user"], d["password"])].append(d["result"].host)
+
+            for (user, pw), hostlist in batches.items():
+                res = self.pb.run_detailed(playbook, hostlist, user, pw, dry_run=dry_run)
+                ok, duration, failed_hosts = res.as_tuple()
+                task_timings.update(res.host_tasks)
+                duration_total += duration
+                batch_results.append((user, duration, failed_hosts))
+                if (not ok) or failed_hosts:
+                    any_failed = True
+                    all_failed_hosts.extend(failed_hosts or [])
+                    log.warning(f"FAILED cluster {cluster_name} batch user={user} dur={duration:.1f}s hosts={','.join(hostlist)} "
+                                f"failed_hosts={','.join(failed_hosts) if failed_hosts else ''}")
+                else:
+                    log.info(f"OK cluster {cluster_name} batch user={user} dur={duration:.1f}s hosts={','.join(hostlist)}")
+
+            # En misslyckad våg stoppar resten: fler värdar får inte tas ner
+            if any_failed:
+                break
+            if len(waves) > 1 and self.health_probe is not None:
+                started = time.monotonic()
+                unhealthy = self._health_gate(wave)
+                duration_total += time.monotonic() - started
+                if unhealthy:
+                    any_failed = True
+                    all_failed_hosts.extend(h for h, _ in unhealthy)
+                    gate_reason = (f"health gate efter våg {wave_no}/{len(waves)}: "
+                                   + ", ".join(f"{h}({why})" for h, why in unhealthy))
+                    log.warning(f"FAILED cluster {cluster_name}: {gate_reason}")
+                    break
+                log.info(f"cluster {cluster_name}: våg {wave_no}/{len(waves)} frisk")
 
         if any_failed:
             reason = ("playbook failed on: " + ",".join(sorted(set(all_failed_hosts)))) if all_failed_hosts else "playbook failed"
+            if gate_reason:
+                reason = gate_reason
             return ClusterOutcome(cluster=cluster_name, status="FAILED", reason=reason,
                                   duration_total=duration_total, failed_hosts=sorted(set(all_failed_hosts)),
-                                  batch_results=batch_results)
+                                  batch_results=batch_results, task_timings=task_timings)
 
         return ClusterOutcome(cluster=cluster_name, status="OK", reason="patch ok",
                               duration_total=duration_total, failed_hosts=[],
-                              batch_results=batch_results)
+                              batch_results=batch_results, task_timings=task_timings)
+
+    def run_clusters(self, cluster_rows: Dict[str, List[Dict[str, Any]]], dry_run: bool,
+                     max_parallel: int = 1, per_playbook: Optional[int] = None) -> List[ClusterOutcome]:
+        """
+        Kör oberoende kluster parallellt, högst max_parallel samtidigt och högst
+        per_playbook samtidigt per playbook. Resultatet kommer i cluster_rows-ordning.
+        """
+        names = list(cluster_rows)
+        if max_parallel <= 1 or len(names) <= 1:
+            return [self._done(self.run_cluster(c, cluster_rows[c], dry_run)) for c in names]
+
+        playbook_of = {c: self.pb.get_playbook(c) for c in names}
+        running_per_playbook: Dict[str, int] = defaultdict(int)
+        pending = list(names)
+        results: Dict[str, ClusterOutcome] = {}
+
+        with ThreadPoolExecutor(max_workers=max_parallel) as ex:
+            running = {}
+            while pending or running:
+                for cname in list(pending):
+                    if len(running) >= max_parallel:
+                        break
+                    pbk = playbook_of[cname]
+                    if per_playbook and running_per_playbook[pbk] >= per_playbook:
+                        continue
+                    pending.remove(cname)
+                    running_per_playbook[pbk] += 1
+                    running[ex.submit(self.run_cluster, cname, cluster_rows[cname], dry_run)] = cname
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in done:
+                    cname = running.pop(f)
+                    running_per_playbook[playbook_of[cname]] -= 1
+                    results[cname] = self._done(f.result())
+
+        return [results[c] for c in names]
+
+
+class PatchPipeline:
+    """
+    Patchar medan probningen pågår: submit(row) anropas för varje probe-resultat.
+    En standalone-värd köas direkt, ett kluster när alla dess medlemmar är probade.
+    Standalone-värdar patchas en i taget (som utan pipeline), kluster högst
+    max_parallel samtidigt och högst per_playbook per playbook. Bland köade jobb
+    startas det med högst prioritet (t.ex. förväntad patchtid) först.
+    """
+
+    def __init__(self, helper: Helper, standalone: List[str], clusters: Dict[str, List[str]], dry_run: bool,
+                 max_parallel: int = 1, per_playbook: Optional[int] = None,
+                 skip_hosts=(), skip_clusters=(),
+                 host_priority: Optional[Callable[[str], float]] = None,
+                 cluster_priority: Optional[Callable[[str], float]] = None):
+        self.helper = helper
+        self.dry_run = dry_run
+        self.max_parallel = max(1, int(max_parallel))
+        self.per_playbook = per_playbook
+        self._host_priority = host_priority or (lambda h: 0.0)
+        self._cluster_priority = cluster_priority or (lambda c: 0.0)
+
+        self._standalone = set(standalone) - set(skip_hosts)
+        self._members = {c: list(m) for c, m in clusters.items() if c not in skip_clusters}
+        self._waiting = {c: set(m) for c, m in self._members.items()}
+        self._clusters_of: Dict[str, List[str]] = defaultdict(list)
+        for cname, members in self._members.items():
+            for h in members:
+                self._clusters_of[h].append(cname)
+
+        self._lock = threading.Lock()
+        self._rows: Dict[str, Dict[str, Any]] = {}
+        self._pending_hosts: List[Tuple[float, str]] = []
+        self._pending_clusters: List[Tuple[float, str]] = []
+        self._host_running = False
+        self._running = 0
+        self._running_per_playbook: Dict[str, int] = defaultdict(int)
+        self._futures = []
+        self._ex = ThreadPoolExecutor(max_workers=1 + self.max_parallel, thread_name_prefix="patch")
+        self.host_outcomes: Dict[str, HostOutcome] = {}
+        self.cluster_outcomes: Dict[str, ClusterOutcome] = {}
+
+        with self._lock:
+            # Kluster utan medlemmar väntar inte på någon probe
+            for cname in [c for c, w in self._waiting.items() if not w]:
+                self._cluster_ready(cname)
+            self._dispatch()
+
+    def submit(self, row: Dict[str, Any]) -> None:
+        host = row["host"]
+        with self._lock:
+            if host in self._rows:
+                return
+            self._rows[host] = row
+            if host in self._standalone:
+                heapq.heappush(self._pending_hosts, (-self._host_priority(host), host))
+            for cname in self._clusters_of.get(host, ()):
+                waiting = self._waiting[cname]
+                waiting.discard(host)
+                if not waiting:
+                    self._cluster_ready(cname)
+            self._dispatch()
+
+    def _cluster_ready(self, cname: str) -> None:
+        del self._waiting[cname]
+        heapq.heappush(self._pending_clusters, (-self._cluster_priority(cname), cname))
+
+    def _dispatch(self) -> None:
+        # Anropas med self._lock hållet
+        if not self._host_running and self._pending_hosts:
+            _, host = heapq.heappop(self._pending_hosts)
+            self._host_running = True
+            self._futures.append(self._ex.submit(self._patch_host, host))
+
+        blocked = []
+        while self._pending_clusters and self._running < self.max_parallel:
+            item = heapq.heappop(self._pending_clusters)
+            playbook = self.helper.pb.get_playbook(item[1])
+            if self.per_playbook and self._running_per_playbook[playbook] >= self.per_playbook:
+                blocked.append(item)
+                continue
+            self._running += 1
+            self._running_per_playbook[playbook] += 1
+            self._futures.append(self._ex.submit(self._patch_cluster, item[1], playbook))
+        for item in blocked:
+            heapq.heappush(self._pending_clusters, item)
+
+    def _patch_host(self, host: str) -> None:
+        try:
+            outcome = self.helper.run_standalone([self._rows[host]], dry_run=self.dry_run)[0]
+            self.host_outcomes[host] = outcome
+        finally:
+            with self._lock:
+                self._host_running = False
+                self._dispatch()
+
+    def _patch_cluster(self, cname: str, playbook: str) -> None:
+        try:
+            rows = sorted((self._rows[h] for h in self._members[cname]), key=lambda x: x["result"].host)
+            self.cluster_outcomes[cname] = self.helper._done(self.helper.run_cluster(cname, rows, self.dry_run))
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._running_per_playbook[playbook] -= 1
+                self._dispatch()
+
+    def wait(self) -> Tuple[Dict[str, HostOutcome], Dict[str, ClusterOutcome]]:
+        """Väntar tills allt köat är patchat; anropas när alla probe-resultat har skickats in."""
+        running, finished = set(), []
+        while True:
+            # Ett jobb köar nästa innan det självt räknas som klart, så när inga
+            # futures är ofärdiga och inga nya har tillkommit finns inget kvar
+            with self._lock:
+                running.update(self._futures)
+                self._futures = []
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            finished.extend(done)
+        self._ex.shutdown()
+        for f in finished:
+            f.result()
+        if self._waiting:
+            log.warning(f"pipeline: kluster utan probe-resultat för alla medlemmar: {','.join(sorted(self._waiting))}")
+        return self.host_outcomes, self.cluster_outcomes
@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import copy
 import logging
+import math
 import socket
 import subprocess
 import platform
+import time
 from dataclasses import dataclass
-from typing import Optional, Dict, Any
+from typing import Optional, Callable, Dict, Any, List, Tuple
+
+from BatchPinger import BatchPinger
 
 log = logging.getLogger(__name__)
 
+_SYSTEM = platform.system().lower()
+PING_BACKENDS = ("subprocess", "batch")
+
 @dataclass
 class ProbeResult:
     host: str
@@ -21,8 +30,43 @@ class ProbeResult:
     error: Optional[str] = None
 
 class HostProbe:
-    def __init__(self, timeout: float = 3.0):
+    def __init__(self, timeout: float = 3.0, ping_backend: str = "subprocess", control=None, metrics=None):
+        if ping_backend not in PING_BACKENDS:
+            raise ValueError(f"okänd ping_backend: {ping_backend}")
         self.timeout = timeout
+        self.ping_backend = ping_backend
+        self.control = control
+        # Metrics.RunMetrics; latens per steg (ping, tcp, ssh) registreras när den är satt
+        self.metrics = metrics
+        self._ping_results: Dict[str, bool] = {}
+
+    def prefetch_ping(self, ips: List[str]) -> None:
+        """
+        Med ping_backend="batch": pinga alla adresser i ett svep innan proberna
+        startar. Anropas inför varje probe-pass; svar från ett tidigare pass
+        (t.ex. ett tidigare daemon-jobb) används aldrig.
+        """
+        self._ping_results = {}
+        if self.ping_backend != "batch" or not ips:
+            return
+        start = time.monotonic()
+        results = BatchPinger(timeout=self.timeout).ping_many(ips)
+        self._ping_results = results
+        if self.metrics:
+            # Svepet ger ingen tid per värd; hela svepet och utfallet per värd registreras
+            self.metrics.observe_batch_ping(time.monotonic() - start, results)
+        log.info(f"Batch ping: {sum(results.values())}/{len(results)} svarade")
+
+    def for_recheck(self) -> "HostProbe":
+        """
+        Kopia som alltid pingar på nytt, för omprober under körningen (hälsokontrollen
+        efter en klustervåg): de förhämtade svaren är från före patchningen.
+        """
+        clone = copy.copy(self)
+        clone._ping_results = {}
+        # Omprober hör inte hemma i flottans latenshistogram
+        clone.metrics = None
+        return clone
 
     def probe(self, host: str, vars: Dict[str, Any], ssh_user: str, ssh_pass: str) -> ProbeResult:
         ip = vars.get("ansible_host", host)
@@ -35,34 +79,159 @@ class HostProbe:
             log.debug(f"probe error host={host} ip={ip}: {err}")
         return ProbeResult(host, ip, ping_ok, ssh_ok, ssh_login_ok, ssh_user, err)
 
+    def _ping_cmd(self, ip: str) -> List[str]:
+        wait = max(1, math.ceil(self.timeout))
+        if _SYSTEM.startswith("win"):
+            return ["ping", "-n", "1", "-w", str(wait * 1000), ip]
+        if _SYSTEM == "darwin":
+            return ["ping", "-c", "1", "-t", str(wait), ip]
+        return ["ping", "-c", "1", "-W", str(wait), ip]
+
+    def _ssh_cmd(self, ip: str, user: str, password: str) -> List[str]:
+        control_opts = self.control.ssh_options() if self.control else []
+        return [
+            "sshpass", "-p", password,
+            "ssh", "-o", "BatchMode=no",
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "UserKnownHostsFile=/dev/null",
+            "-o", f"ConnectTimeout={int(self.timeout)}",
+            *control_opts,
+            f"{user}@{ip}", "true"
+        ]
+
+    def _login_done(self, ip: str, user: str, ok: bool) -> None:
+        if ok and self.control:
+            self.control.register(user, ip)
+
+    def _observe(self, step: str, start: float, ok: bool) -> bool:
+        if self.metrics:
+            self.metrics.observe_probe(step, time.monotonic() - start, ok)
+        return ok
+
     def _ping(self, ip: str) -> bool:
-        sys = platform.system().lower()
-        cmd = ["ping", "-n", "1", ip] if sys.startswith("win") else ["ping", "-c", "1", ip]
-        rc = subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return rc == 0
+        if ip in self._ping_results:
+            return self._ping_results[ip]
+        start = time.monotonic()
+        rc = subprocess.call(self._ping_cmd(ip), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return self._observe("ping", start, rc == 0)
 
     def _port_open(self, ip: str, port: int) -> bool:
+        start = time.monotonic()
         try:
             with socket.create_connection((ip, port), timeout=self.timeout):
-                return True
+                return self._observe("tcp", start, True)
         except OSError as e:
             log.debug(f"_port_open {ip}:{port} -> {e}")
-            return False
+            return self._observe("tcp", start, False)
 
     def _ssh_login(self, ip: str, user: str, password: str):
+        start = time.monotonic()
         try:
             res = subprocess.run(
-                [
-                    "sshpass", "-p", password,
-                    "ssh", "-o", "BatchMode=no",
-                    "-o", "StrictHostKeyChecking=no",
-                    "-o", "UserKnownHostsFile=/dev/null",
-                    "-o", f"ConnectTimeout={int(self.timeout)}",
-                    f"{user}@{ip}", "true"
-                ],
+                self._ssh_cmd(ip, user, password),
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.DEVNULL
             )
-            return (res.returncode == 0, None)
+            self._login_done(ip, user, res.returncode == 0)
+            return (self._observe("ssh", start, res.returncode == 0), None)
+        except Exception as e:
+            self._observe("ssh", start, False)
+            return (False, str(e))
+
+
+class AsyncHostProbe(HostProbe):
+    """
+    Asyncio-variant av HostProbe för stora flottor.
+
+    Alla steg (ping, port 22, ssh-login) körs som korutiner och antalet
+    samtidiga prober begränsas av en semafor. Returnerar samma ProbeResult.
+    """
+
+    def __init__(self, timeout: float = 3.0, max_concurrency: int = 256, ping_backend: str = "subprocess",
+                 control=None, metrics=None):
+        super().__init__(timeout, ping_backend=ping_backend, control=control, metrics=metrics)
+        self.max_concurrency = max(1, int(max_concurrency))
+
+    def probe(self, host: str, vars: Dict[str, Any], ssh_user: str, ssh_pass: str) -> ProbeResult:
+        return asyncio.run(self.probe_async(host, vars, ssh_user, ssh_pass))
+
+    def probe_many(self, jobs: List[Tuple[str, Dict[str, Any], str, str]],
+                   on_done: Optional[Callable[[int, ProbeResult], None]] = None) -> List[ProbeResult]:
+        """
+        Probar alla (host, vars, user, password) och returnerar resultaten i samma ordning.
+        on_done(index, result) anropas för varje jobb så fort det är klart.
+        """
+        if not jobs:
+            return []
+        return asyncio.run(self._probe_many(jobs, on_done))
+
+    async def _probe_many(self, jobs, on_done=None) -> List[ProbeResult]:
+        sem = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded(idx, job):
+            async with sem:
+                res = await self.probe_async(*job)
+            if on_done:
+                on_done(idx, res)
+            return res
+
+        return await asyncio.gather(*(bounded(i, j) for i, j in enumerate(jobs)))
+
+    async def probe_async(self, host: str, vars: Dict[str, Any], ssh_user: str, ssh_pass: str) -> ProbeResult:
+        ip = vars.get("ansible_host", host)
+        ping_ok, ssh_ok = await asyncio.gather(self._ping_async(ip), self._port_open_async(ip, 22))
+        ssh_login_ok, err = (None, None)
+        if ssh_ok:
+            ssh_login_ok, err = await self._ssh_login_async(ip, ssh_user, ssh_pass)
+        if err:
+            log.debug(f"probe error host={host} ip={ip}: {err}")
+        return ProbeResult(host, ip, ping_ok, ssh_ok, ssh_login_ok, ssh_user, err)
+
+    async def _run(self, cmd: List[str], limit: float) -> int:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            return await asyncio.wait_for(proc.wait(), timeout=limit)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise
+
+    async def _ping_async(self, ip: str) -> bool:
+        if ip in self._ping_results:
+            return self._ping_results[ip]
+        start = time.monotonic()
+        try:
+            return self._observe("ping", start, await self._run(self._ping_cmd(ip), self.timeout + 1) == 0)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.debug(f"_ping_async {ip} -> {e!r}")
+            return self._observe("ping", start, False)
+
+    async def _port_open_async(self, ip: str, port: int) -> bool:
+        start = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.debug(f"_port_open_async {ip}:{port} -> {e!r}")
+            return self._observe("tcp", start, False)
+        self._observe("tcp", start, True)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+    async def _ssh_login_async(self, ip: str, user: str, password: str):
+        start = time.monotonic()
+        try:
+            rc = await self._run(self._ssh_cmd(ip, user, password), self.timeout * 4)
+            self._login_done(ip, user, rc == 0)
+            return (self._observe("ssh", start, rc == 0), None)
+        except asyncio.TimeoutError:
+            self._observe("ssh", start, False)
+            return (False, "ssh login timeout")
         except Exception as e:
+            self._observe("ssh", start, False)
             return (False, str(e))
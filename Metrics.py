@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+log = logging.getLogger(__name__)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Sekunder; prober tar millisekunder till timeout, playbooks och faser minuter till timmar
+PROBE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PLAYBOOK_BUCKETS = (10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 1800.0, 3600.0, 7200.0, 14400.0)
+PHASE_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 600.0, 1800.0, 3600.0, 7200.0, 14400.0, 28800.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str], lock: threading.Lock):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = lock
+        self._values: Dict[Labels, object] = {}
+
+    def family(self, openmetrics: bool) -> str:
+        return self.name
+
+    def header(self, openmetrics: bool) -> List[str]:
+        family = self.family(openmetrics)
+        return [f"# HELP {family} {self.help}", f"# TYPE {family} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, labels: Labels, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def family(self, openmetrics: bool) -> str:
+        # OpenMetrics namnger familjen utan _total; proverna har det i båda formaten
+        return self.name[:-len("_total")] if openmetrics else self.name
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, labels: Labels, value: float) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str], lock: threading.Lock,
+                 buckets: Sequence[float]):
+        super().__init__(name, help, labelnames, lock)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, labels: Labels, value: float) -> None:
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # [antal per hink (ej kumulativt) ..., +Inf], summa
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            state[1] += value
+
+    def samples(self) -> List[str]:
+        out = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                le = f'le="{_number(bound)}"'
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return out
+
+
+class MetricsRegistry:
+    """
+    Mätvärden för autopatch: latens per probe-steg, playbook- och fastider samt
+    antal OK/FAILED/SKIPPED. Renderas i Prometheus textformat (det som
+    node_exporters textfile collector läser) eller som OpenMetrics. I CLI-läge
+    gäller registret en körning; i daemon-läge ackumuleras det över jobben.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: List[_Metric] = []
+        self.probe_ping = self._add(Histogram(
+            "autopatch_probe_ping_seconds", "Tid för ping per värd.",
+            ("env", "result"), self._lock, PROBE_BUCKETS))
+        self.probe_batch_ping = self._add(Histogram(
+            "autopatch_probe_batch_ping_seconds", "Tid för ett ping-svep över alla värdar (--ping-backend batch).",
+            ("env",), self._lock, PROBE_BUCKETS))
+        self.probe_batch_ping_hosts = self._add(Counter(
+            "autopatch_probe_batch_ping_hosts_total", "Värdar pingade i ping-svep.",
+            ("env", "result"), self._lock))
+        self.probe_tcp = self._add(Histogram(
+            "autopatch_probe_tcp_connect_seconds", "Tid för TCP-anslutning till port 22 per värd.",
+            ("env", "result"), self._lock, PROBE_BUCKETS))
+        self.probe_ssh = self._add(Histogram(
+            "autopatch_probe_ssh_login_seconds", "Tid för ssh-inloggning per värd.",
+            ("env", "result"), self._lock, PROBE_BUCKETS))
+        self.playbook = self._add(Histogram(
+            "autopatch_playbook_duration_seconds", "Tid per ansible-playbook-körning.",
+            ("env", "playbook", "result"), self._lock, PLAYBOOK_BUCKETS))
+        self.phase = self._add(Histogram(
+            "autopatch_phase_duration_seconds", "Tid per fas i en autopatch-körning.",
+            ("env", "phase"), self._lock, PHASE_BUCKETS))
+        self.outcomes = self._add(Counter(
+            "autopatch_patch_outcomes_total", "Patchutfall per standalone-värd och kluster.",
+            ("env", "kind", "status"), self._lock))
+        self.last_run = self._add(Gauge(
+            "autopatch_last_run_timestamp_seconds", "Unix-tid när senaste fullständiga körning blev klar.",
+            ("env",), self._lock))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def for_env(self, env: str) -> "RunMetrics":
+        return RunMetrics(self, env)
+
+    def render(self, openmetrics: bool = False) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for metric in self._metrics:
+                lines += metric.header(openmetrics)
+                lines += metric.samples()
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        """Atomiskt (tmp + rename i samma katalog) så att node_exporter aldrig läser en halv fil."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        log.info(f"Metrics skrivna till {path}")
+
+
+class RunMetrics:
+    """Registret bundet till en miljö; det som HostProbe, PlaybookExecutor och main använder."""
+
+    def __init__(self, registry: MetricsRegistry, env: str):
+        self.registry = registry
+        self.env = env
+
+    def observe_probe(self, step: str, seconds: float, ok: bool) -> None:
+        metric = {"ping": self.registry.probe_ping, "tcp": self.registry.probe_tcp,
+                  "ssh": self.registry.probe_ssh}[step]
+        metric.observe((self.env, "ok" if ok else "fail"), seconds)
+
+    def observe_batch_ping(self, seconds: float, results: Dict[str, bool]) -> None:
+        self.registry.probe_batch_ping.observe((self.env,), seconds)
+        ok = sum(1 for v in results.values() if v)
+        for result, n in (("ok", ok), ("fail", len(results) - ok)):
+            if n:
+                self.registry.probe_batch_ping_hosts.inc((self.env, result), n)
+
+    def observe_playbook(self, playbook: str, seconds: float, ok: bool) -> None:
+        self.registry.playbook.observe((self.env, playbook, "ok" if ok else "fail"), seconds)
+
+    def count_outcomes(self, kind: str, outcomes) -> None:
+        for o in outcomes:
+            self.registry.outcomes.inc((self.env, kind, o.status))
+
+    def run_finished(self) -> None:
+        self.registry.last_run.set((self.env,), time.time())
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.registry.phase.observe((self.env, name), time.monotonic() - start)
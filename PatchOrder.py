@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import statistics
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Används när varken värden/klustret eller någon annan har historik
+DEFAULT_DURATION = 300.0
+
+
+class DurationEstimator:
+    """
+    Förväntad patchtid per värd och kluster, från tidigare körningars
+    duration/duration_total (median över de senaste körningarna). Okända
+    värdar/kluster får `default`, som standard medianen av de kända.
+    """
+
+    def __init__(self, hosts: Dict[str, float], clusters: Dict[str, float], default: Optional[float] = None):
+        self.hosts = hosts
+        self.clusters = clusters
+        known = list(hosts.values()) + list(clusters.values())
+        if default is None:
+            default = statistics.median(known) if known else DEFAULT_DURATION
+        self.default = float(default)
+
+    def host(self, name: str) -> float:
+        return self.hosts.get(name, self.default)
+
+    def cluster(self, name: str) -> float:
+        return self.clusters.get(name, self.default)
+
+    @classmethod
+    def from_history(cls, history, env: str, last: int = 10, default: Optional[float] = None) -> "DurationEstimator":
+        """Från RunHistory (SQLite)."""
+        hosts = {h: s["p50"] for h, s in history.duration_percentiles(env, percentiles=(50,), last=last).items()}
+        clusters = {c: s["p50"] for c, s in
+                    history.duration_percentiles(env, percentiles=(50,), last=last, clusters=True).items()}
+        return cls(hosts, clusters, default)
+
+    @classmethod
+    def from_reports(cls, reports_dir: str, env: str, last: int = 10,
+                     default: Optional[float] = None) -> "DurationEstimator":
+        """
+        Från de senaste rapporterna i reports/index.jsonl (när ingen
+        historikdatabas används). --dry-run-körningar hoppas över.
+        """
+        from ReportGenerator import load_report, read_index
+
+        host_runs: Dict[str, List[float]] = {}
+        cluster_runs: Dict[str, List[float]] = {}
+        entries = [e for e in read_index(reports_dir, env=env) if not e.get("dry_run")]
+        for entry in entries[-last:]:
+            try:
+                model = load_report(os.path.join(reports_dir, entry["report"]))
+            except (OSError, ValueError, KeyError) as e:
+                log.debug(f"Hoppar över rapport {entry.get('report')}: {e}")
+                continue
+            for item in model["standalone"]["items"]:
+                if item["patch"]["status"] != "SKIPPED":
+                    host_runs.setdefault(item["host"], []).append(item["patch"]["duration"])
+            for co in model["clusters"]["summary"]:
+                if co["status"] != "SKIPPED":
+                    cluster_runs.setdefault(co["cluster"], []).append(co["duration_total"])
+        return cls({h: statistics.median(v) for h, v in host_runs.items()},
+                   {c: statistics.median(v) for c, v in cluster_runs.items()}, default)
+
+
+def longest_first(items: Iterable[T], estimate: Callable[[T], float], name: Callable[[T], str] = str) -> List[T]:
+    """Längst förväntad tid först (LPT); lika långa i namnordning så att ordningen är stabil."""
+    return sorted(items, key=lambda x: (-estimate(x), name(x)))
@@ -1,19 +1,134 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import ast
 import os
-import sys
+import re
+import shlex
 import subprocess
 import datetime
+import itertools
+import json
 import logging
-from typing import List
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+CALLBACK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "callback_plugins")
+CALLBACK_NAME = "autopatch_events"
+
+SUMMARY_KEYS = ("FAILED!", "UNREACHABLE!", "MODULE FAILURE", "MSG:", "ERROR!")
+SUMMARY_LINES = 20
+_TASK_RE = re.compile(r"^TASK \[(.*)\]")
+# Kan pekas om, t.ex. till benchmarks/fake_ansible_playbook.py, utan att ändra PATH
+ANSIBLE_PLAYBOOK_ENV = "AUTOPATCH_ANSIBLE_PLAYBOOK"
+
+
+@dataclass
+class PlaybookProgress:
+    hosts: List[str]
+    line_no: int
+    task: str
+    failed_host: Optional[str] = None
+
+
+@dataclass
+class PlaybookResult:
+    ok: bool
+    duration: float
+    failed_hosts: List[str]
+    rc: Optional[int] = None
+    # host -> [{"task", "action", "status", "duration"}] från autopatch_events-callbacken
+    host_tasks: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
+    # Värdar som nådde sista playens sista task (enligt callbacken); None om okänt
+    finished_hosts: Optional[List[str]] = None
+
+    def as_tuple(self):
+        return self.ok, self.duration, self.failed_hosts
+
+
+@dataclass
+class _OutputScanner:
+    """Inkrementell tolkning av ansible-utdata, en rad i taget."""
+    failed: List[str] = field(default_factory=list)
+    summary: List[str] = field(default_factory=list)
+    task: str = ""
+    lines: int = 0
+
+    def __post_init__(self):
+        self._seen = set(self.failed)
+        self._last_failed: Optional[str] = None
+
+    def feed(self, line: str) -> Optional[str]:
+        """Returnerar värdnamnet om raden gav en ny misslyckad värd."""
+        self.lines += 1
+        line = line.strip()
+        if not line:
+            return None
+
+        # fatal-raden följd av "...ignoring" är ett fel med ignore_errors: inte misslyckad
+        last, self._last_failed = self._last_failed, None
+        if line == "...ignoring":
+            if last is not None:
+                self._seen.discard(last)
+                self.failed.remove(last)
+            return None
+
+        if line.startswith("TASK ["):
+            m = _TASK_RE.match(line)
+            if m:
+                self.task = m.group(1)
+            return None
+
+        if len(self.summary) < SUMMARY_LINES and any(key in line for key in SUMMARY_KEYS):
+            self.summary.append(line)
+
+        host = None
+        # Vanlig fatal-rad från Ansible
+        if line.startswith("fatal:"):
+            lbr = line.find("[")
+            rbr = line.find("]", lbr + 1)
+            if lbr != -1 and rbr != -1:
+                host = line[lbr + 1 : rbr] or None
+
+        # Andra rader med FAILED!/UNREACHABLE!
+        if host is None and ("FAILED!" in line or "UNREACHABLE!" in line):
+            parts = line.split()
+            if parts:
+                cand = parts[0].rstrip(":")
+                if cand and not cand.lower().startswith("fatal"):
+                    host = cand
+
+        if host and host not in self._seen:
+            self._seen.add(host)
+            self.failed.append(host)
+            self._last_failed = host
+            return host
+        return None
+
 
 class PlaybookExecutor:
-    def __init__(self, inventory_path: str):
+    _spool_seq = itertools.count(1)
+
+    def __init__(self, inventory_path: str, ssh_control=None, spool_dir: Optional[str] = None,
+                 progress: Optional[Callable[[PlaybookProgress], None]] = None,
+                 ansible_playbook: Optional[str] = None, metrics=None):
         self.inventory_path = inventory_path
+        self.ssh_control = ssh_control
+        self.spool_dir = spool_dir
+        self.progress = progress
+        # Metrics.RunMetrics; tid per playbook-körning registreras när den är satt
+        self.metrics = metrics
+        # Kommandot kan ha argument ("python3 fake_ansible_playbook.py --fail-rate 0.1")
+        self.ansible_playbook = shlex.split(
+            ansible_playbook or os.environ.get(ANSIBLE_PLAYBOOK_ENV) or "ansible-playbook"
+        )
+        # (callback-kataloger, aktiverade callbacks) ur ansible.cfg; läses en gång per instans
+        self._callback_settings: Optional[Tuple[List[str], List[str]]] = None
+        self._callback_lock = threading.Lock()
 
     def get_playbook(self, group: str) -> str:
         playbook_map = {
@@ -26,14 +141,19 @@ class PlaybookExecutor:
         logger.debug(f"Selected playbook for group={group}: {p}")
         return p
 
-    def run(self, playbook_path: str, hosts, ssh_user: str, ssh_pass: str, dry_run: bool = False):
+    def run(self, playbook_path: str, hosts, ssh_user: str, ssh_pass: str, dry_run: bool = False,
+            forks: Optional[int] = None):
+        return self.run_detailed(playbook_path, hosts, ssh_user, ssh_pass, dry_run=dry_run, forks=forks).as_tuple()
+
+    def run_detailed(self, playbook_path: str, hosts, ssh_user: str, ssh_pass: str, dry_run: bool = False,
+                     forks: Optional[int] = None) -> PlaybookResult:
         start = datetime.datetime.now()
         env = os.environ.copy()
         env["ANSIBLE_BECOME_PASS"] = ssh_pass
         env["ANSIBLE_ASK_BECOME_PASS"] = "false"
 
         cmd = [
-            "ansible-playbook",
+            *self.ansible_playbook,
             "-i", self.inventory_path,
             playbook_path,
             "-l", ",".join(hosts),
@@ -43,6 +163,12 @@ class PlaybookExecutor:
                 f"ansible_become=true ansible_become_pass={ssh_pass}"
             ),
         ]
+        if forks:
+            cmd += ["--forks", str(forks)]
+        if self.ssh_control:
+            # Återanvänd ControlMaster-sockets som öppnades under proben
+            env.update(self.ssh_control.ansible_env())
+            cmd += ["--ssh-common-args", self.ssh_control.ansible_ssh_common_args()]
         if dry_run:
             cmd.append("--check")
 
@@ -51,26 +177,36 @@ class PlaybookExecutor:
             dry_run, hosts, playbook_path, ssh_user
         )
 
+        base = self._spool_base(playbook_path, hosts)
+        events_path = self._enable_events(env, base)
         try:
-            if sys.version_info >= (3, 7):
-                result = subprocess.run(cmd, capture_output=True, text=True, env=env)
-            else:
-                result = subprocess.run(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    universal_newlines=True,
-                    env=env,
-                )
+            with self._spool(base, "stdout") as out_f, self._spool(base, "stderr") as err_f:
+                scanner, rc = self._stream(cmd, env, hosts, out_f, err_f)
+                # stderr kan också innehålla FAILED!/UNREACHABLE!-rader
+                err_f.seek(0)
+                err_lines: List[str] = []
+                for line in err_f:
+                    scanner.feed(line)
+                    if line.strip() and len(err_lines) < SUMMARY_LINES:
+                        err_lines.append(line.strip())
+                out_name, err_name = out_f.name, err_f.name
+            events = self._read_events(events_path)
         except Exception as e:
             logger.exception(f"Playbook subprocess failed: {e}")
-            return False, 0.0, []
+            return PlaybookResult(False, 0.0, [])
+        finally:
+            if not base and os.path.exists(events_path):
+                os.unlink(events_path)
 
         duration = (datetime.datetime.now() - start).total_seconds()
-        stdout = result.stdout or ""
-        stderr = result.stderr or ""
-        ok = result.returncode == 0
-        failed_hosts = self._parse_failed_hosts(stdout, stderr)
+        ok = rc == 0
+        if self.metrics:
+            self.metrics.observe_playbook(os.path.splitext(os.path.basename(playbook_path))[0], duration, ok)
+        if events is not None:
+            # Callbacken ser ignore_errors och recap; textskanningen är bara reserv
+            failed_hosts, host_tasks, finished_hosts = events
+        else:
+            failed_hosts, host_tasks, finished_hosts = list(scanner.failed), {}, None
 
         if ok:
             logger.info("Playbook OK (%.1fs) hosts=%s", duration, hosts)
@@ -82,17 +218,172 @@ class PlaybookExecutor:
         else:
             logger.warning(
                 "Playbook FAILED rc=%s (%.1fs) hosts=%s",
-                result.returncode, duration, hosts,
+                rc, duration, hosts,
             )
-            self._log_failure_summary(stdout, stderr)
+            self._log_failure_summary(scanner.summary, err_lines)
 
         if failed_hosts:
             logger.warning("Failed hosts detected: %s", ",".join(failed_hosts))
 
-        logger.debug("Playbook full STDOUT:\n%s", stdout)
-        logger.debug("Playbook full STDERR:\n%s", stderr)
+        if self.spool_dir:
+            logger.debug("Playbook STDOUT (%d rader): %s", scanner.lines, out_name)
+            logger.debug("Playbook STDERR: %s", err_name)
+
+        for host, tasks in host_tasks.items():
+            slowest = max(tasks, key=lambda t: t["duration"], default=None)
+            if slowest:
+                logger.debug("Slowest task host=%s task='%s' (%.1fs)", host, slowest["task"], slowest["duration"])
 
-        return ok, duration, failed_hosts
+        return PlaybookResult(ok, duration, failed_hosts, rc=rc, host_tasks=host_tasks,
+                              finished_hosts=finished_hosts)
+
+    def _enable_events(self, env: Dict[str, str], base: Optional[str]) -> str:
+        """Aktiverar den medföljande autopatch_events-callbacken och returnerar händelsefilen."""
+        if base:
+            path = f"{base}.events.jsonl"
+        else:
+            fd, path = tempfile.mkstemp(prefix="autopatch-events-", suffix=".jsonl")
+            os.close(fd)
+        open(path, "w").close()
+        env["AUTOPATCH_EVENTS_FILE"] = path
+        # Miljövariablerna ersätter ansible.cfg-värdena, så de konfigurerade måste följa med
+        with self._callback_lock:
+            if self._callback_settings is None:
+                self._callback_settings = self._callback_config(env)
+        configured_dirs, enabled = self._callback_settings
+        enabled = list(enabled)
+        plugin_dirs = [CALLBACK_DIR] + [p for p in configured_dirs if p != CALLBACK_DIR]
+        env["ANSIBLE_CALLBACK_PLUGINS"] = os.pathsep.join(plugin_dirs)
+        if CALLBACK_NAME not in enabled:
+            enabled.append(CALLBACK_NAME)
+        for key in ("ANSIBLE_CALLBACKS_ENABLED", "ANSIBLE_CALLBACK_WHITELIST"):
+            env[key] = ",".join(enabled)
+        return path
+
+    def _callback_config(self, env: Dict[str, str]) -> Tuple[List[str], List[str]]:
+        """
+        (callback-kataloger, aktiverade callbacks) som ansible-playbook hade
+        använt utan autopatch: ansible.cfg och miljön, via ansibles ConfigManager,
+        annars `ansible-config dump`, annars bara miljön.
+        """
+        try:
+            from ansible.config.manager import ConfigManager
+
+            cm = ConfigManager()
+            return (list(cm.get_config_value("DEFAULT_CALLBACK_PLUGIN_PATH") or []),
+                    list(cm.get_config_value("CALLBACKS_ENABLED") or []))
+        except Exception as e:
+            logger.debug(f"ansible ConfigManager otillgänglig: {e}")
+        try:
+            res = subprocess.run(["ansible-config", "dump", "--only-changed"], env=env, stdin=subprocess.DEVNULL,
+                                 capture_output=True, text=True, timeout=60)
+            values = {}
+            for line in res.stdout.splitlines():
+                m = re.match(r"^(DEFAULT_CALLBACK_PLUGIN_PATH|CALLBACKS_ENABLED)\(.*?\) = (.*)$", line)
+                if m:
+                    values[m.group(1)] = list(ast.literal_eval(m.group(2)))
+            if res.returncode == 0:
+                return values.get("DEFAULT_CALLBACK_PLUGIN_PATH", []), values.get("CALLBACKS_ENABLED", [])
+        except (OSError, ValueError, SyntaxError, subprocess.TimeoutExpired) as e:
+            logger.debug(f"ansible-config dump misslyckades: {e}")
+        plugin_dirs = [p for p in env.get("ANSIBLE_CALLBACK_PLUGINS", "").split(os.pathsep) if p]
+        enabled = [c.strip() for key in ("ANSIBLE_CALLBACKS_ENABLED", "ANSIBLE_CALLBACK_WHITELIST")
+                   for c in env.get(key, "").split(",") if c.strip()]
+        return plugin_dirs, list(dict.fromkeys(enabled))
+
+    def _read_events(self, path: str):
+        """
+        Läser händelsefilen rad för rad. Returnerar (failed_hosts, host_tasks,
+        finished_hosts), eller None om callbacken inte skrev någon recap (t.ex.
+        gammal ansible). Misslyckade värdar avgörs av recapen: en failad task som
+        räddas av block/rescue räknas inte där. finished_hosts är de värdar som
+        har ett resultat för sista playens sista task (None om callbacken inte
+        angav den); en avbruten play (any_errors_fatal, max_fail_percentage)
+        når aldrig dit.
+        """
+        failed: Dict[str, None] = {}
+        recap_failed: Dict[str, None] = {}
+        host_tasks: Dict[str, List[Dict[str, Any]]] = {}
+        last_task: Optional[str] = None
+        finished: Dict[str, None] = {}
+        saw_stats = False
+        try:
+            f = open(path, "r", encoding="utf-8")
+        except OSError:
+            return None
+        with f:
+            for line in f:
+                try:
+                    ev = json.loads(line)
+                except ValueError:
+                    continue
+                kind = ev.get("event")
+                if kind == "play_start":
+                    last_task, finished = ev.get("last_task"), {}
+                elif kind == "host_task":
+                    host = ev["host"]
+                    host_tasks.setdefault(host, []).append({
+                        "task": ev.get("task", ""),
+                        "action": ev.get("action", ""),
+                        "status": ev.get("status", ""),
+                        "duration": float(ev.get("duration") or 0.0),
+                    })
+                    if ev.get("status") == "unreachable" or (ev.get("status") == "failed" and not ev.get("ignore_errors")):
+                        failed.setdefault(host)
+                    if last_task is not None and ev.get("task") == last_task:
+                        finished.setdefault(host)
+                elif kind == "stats":
+                    saw_stats = True
+                    for host, counts in (ev.get("hosts") or {}).items():
+                        if counts.get("failures") or counts.get("unreachable"):
+                            recap_failed.setdefault(host)
+        if not saw_stats:
+            return None
+        # I den ordning värdarna failade, sedan de som bara recapen nämner
+        ordered = [h for h in failed if h in recap_failed] + [h for h in recap_failed if h not in failed]
+        return ordered, host_tasks, (list(finished) if last_task is not None else None)
+
+    def _spool_base(self, playbook_path: str, hosts) -> Optional[str]:
+        if not self.spool_dir:
+            return None
+        os.makedirs(self.spool_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(playbook_path))[0]
+        first = hosts[0] if hosts else "none"
+        return os.path.join(self.spool_dir, f"{next(self._spool_seq):04d}_{name}_{first}")
+
+    def _spool(self, base: Optional[str], stream: str):
+        """Utdata skrivs till fil i stället för RAM; utan spool_dir en temporär fil."""
+        if not base:
+            return tempfile.TemporaryFile("w+", encoding="utf-8", errors="replace")
+        return open(f"{base}.{stream}.log", "w+", encoding="utf-8", errors="replace")
+
+    def _stream(self, cmd: List[str], env, hosts, out_f, err_f):
+        scanner = _OutputScanner()
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=err_f,
+            universal_newlines=True,
+            errors="replace",
+            bufsize=1,
+            env=env,
+        )
+        with proc.stdout:
+            for line in proc.stdout:
+                out_f.write(line)
+                task_before = scanner.task
+                new_failed = scanner.feed(line)
+                if self.progress and (new_failed or scanner.task != task_before):
+                    self._notify(PlaybookProgress(list(hosts), scanner.lines, scanner.task, new_failed))
+        rc = proc.wait()
+        out_f.flush()
+        return scanner, rc
+
+    def _notify(self, event: PlaybookProgress) -> None:
+        try:
+            self.progress(event)
+        except Exception as e:
+            logger.debug(f"progress callback failed: {e}")
 
     def _parse_failed_hosts(self, stdout: str, stderr: str = "") -> List[str]:
         """
@@ -101,58 +392,19 @@ class PlaybookExecutor:
         Exempelrad:
         fatal: [svlq-zabbixv01.linux.lnu.se]: FAILED! => ...
         """
-        failed: List[str] = []
-
+        scanner = _OutputScanner()
         for source in (stdout, stderr):
-            if not source:
-                continue
-            for line in source.splitlines():
-                line = line.strip()
-                if not line:
-                    continue
-
-                # Vanlig fatal-rad från Ansible
-                if line.startswith("fatal:"):
-                    lbr = line.find("[")
-                    rbr = line.find("]", lbr + 1)
-                    if lbr != -1 and rbr != -1:
-                        host = line[lbr + 1 : rbr]
-                        if host:
-                            failed.append(host)
-                            continue
-
-                # Andra rader med FAILED!/UNREACHABLE!
-                if "FAILED!" in line or "UNREACHABLE!" in line:
-                    parts = line.split()
-                    if parts:
-                        host = parts[0].rstrip(":")
-                        if host and not host.lower().startswith("fatal"):
-                            failed.append(host)
-
-        seen = set()
-        uniq: List[str] = []
-        for h in failed:
-            if h not in seen:
-                seen.add(h)
-                uniq.append(h)
-        return uniq
-
-    def _log_failure_summary(self, stdout: str, stderr: str) -> None:
-        interesting_stdout = []
-        for line in (stdout or "").splitlines():
-            if any(
-                key in line
-                for key in ("FAILED!", "UNREACHABLE!", "MODULE FAILURE", "MSG:", "ERROR!")
-            ):
-                interesting_stdout.append(line.strip())
+            for line in (source or "").splitlines():
+                scanner.feed(line)
+        return list(scanner.failed)
 
+    def _log_failure_summary(self, interesting_stdout: List[str], err_lines: List[str]) -> None:
         if interesting_stdout:
             logger.warning("Playbook error summary (stdout):")
-            for line in interesting_stdout[:20]:
+            for line in interesting_stdout[:SUMMARY_LINES]:
                 logger.warning("  %s", line)
 
-        err_lines = [l.strip() for l in (stderr or "").splitlines() if l.strip()]
         if err_lines:
             logger.warning("Playbook stderr (första raderna):")
-            for line in err_lines[:20]:
+            for line in err_lines[:SUMMARY_LINES]:
                 logger.warning("  %s", line)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import asdict
+from typing import Any, Dict, Optional
+
+from HostProbe import ProbeResult
+
+log = logging.getLogger(__name__)
+
+
+def probe_healthy(r: ProbeResult) -> bool:
+    return bool(r.ping_ok and r.ssh_ok and r.ssh_login_ok is not False)
+
+
+class ProbeCache:
+    """
+    Diskbaserad cache för ProbeResult, nycklad på host + ansible_host.
+
+    Friska resultat återanvänds i ttl_ok sekunder, misslyckade i ttl_failed
+    sekunder (0 = probas alltid om). Filen skrivs atomiskt i save().
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str, ttl_ok: float = 600.0, ttl_failed: float = 0.0, max_entries: int = 100000):
+        self.path = path
+        self.ttl_ok = float(ttl_ok)
+        self.ttl_failed = float(ttl_failed)
+        self.max_entries = int(max_entries)
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def _key(host: str, ip: str) -> str:
+        return f"{host}|{ip}"
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning(f"Kunde inte läsa probe-cache {self.path}: {e}")
+            return
+        if data.get("version") != self.VERSION:
+            log.info(f"Ignorerar probe-cache {self.path} med annan version")
+            return
+        self._entries = data.get("entries", {})
+
+    def get(self, host: str, ip: str, user: str, now: Optional[float] = None) -> Optional[ProbeResult]:
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(self._key(host, ip))
+        if not entry:
+            return None
+        try:
+            result = ProbeResult(**entry["result"])
+        except TypeError:
+            return None
+        if result.used_user != user:
+            return None
+        ttl = self.ttl_ok if probe_healthy(result) else self.ttl_failed
+        if now - entry["ts"] > ttl:
+            return None
+        return result
+
+    def put(self, result: ProbeResult, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        with self._lock:
+            self._entries[self._key(result.host, result.ip)] = {"ts": now, "result": asdict(result)}
+
+    def evict(self, now: Optional[float] = None) -> int:
+        """Tar bort poster äldre än den längsta TTL:en och kapar till max_entries."""
+        now = time.time() if now is None else now
+        max_age = max(self.ttl_ok, self.ttl_failed)
+        with self._lock:
+            before = len(self._entries)
+            self._entries = {k: v for k, v in self._entries.items() if now - v["ts"] <= max_age}
+            if len(self._entries) > self.max_entries:
+                newest = sorted(self._entries.items(), key=lambda kv: kv[1]["ts"], reverse=True)
+                self._entries = dict(newest[:self.max_entries])
+            return before - len(self._entries)
+
+    def save(self) -> None:
+        with self._lock:
+            payload = {"version": self.VERSION, "entries": dict(self._entries)}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = f"{self.path}.tmp.{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, self.path)
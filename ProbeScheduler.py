@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from HostProbe import AsyncHostProbe
+
+log = logging.getLogger(__name__)
+
+Row = Dict[str, Any]
+
+
+class ProbeScheduler:
+    """
+    Probar hela flottan (standalone + alla klustermedlemmar) i en enda arbetskö
+    och grupperar om resultaten per kluster efteråt.
+
+    context_fn(host) ska returnera en rad-dict med minst "host", "vars",
+    "user" och "password"; schedulern fyller i "result". Med en ProbeCache
+    hämtas färska resultat därifrån och bara övriga värdar probas.
+
+    known är redan kända resultat (t.ex. ur en körjournal) som används som de
+    är; on_result(row) anropas för varje nytt resultat (probat eller cachat).
+    """
+
+    def __init__(self, hp, context_fn: Callable[[str], Row], max_workers: int = 2, cache=None,
+                 on_result: Optional[Callable[[Row], None]] = None):
+        self.hp = hp
+        self.context_fn = context_fn
+        self.max_workers = max(1, int(max_workers))
+        self.cache = cache
+        self.on_result = on_result
+
+    def run(self, standalone: List[str], clusters: Dict[str, List[str]],
+            known: Optional[Dict[str, Any]] = None) -> Tuple[List[Row], Dict[str, List[Row]]]:
+        hosts = list(dict.fromkeys(list(standalone) + [h for members in clusters.values() for h in members]))
+        log.info(f"Probing {len(hosts)} hosts ({len(standalone)} standalone, {len(clusters)} clusters)")
+        by_host = self.probe(hosts, known=known)
+
+        standalone_rows = sorted((by_host[h] for h in standalone), key=lambda x: x["result"].host)
+        cluster_rows = {
+            cname: sorted((by_host[h] for h in members), key=lambda x: x["result"].host)
+            for cname, members in clusters.items()
+        }
+        return standalone_rows, cluster_rows
+
+    def probe(self, hosts: List[str], known: Optional[Dict[str, Any]] = None) -> Dict[str, Row]:
+        rows = [self.context_fn(h) for h in hosts]
+        todo = rows
+        if known:
+            todo = []
+            for d in rows:
+                if d["host"] in known:
+                    d["result"] = known[d["host"]]
+                else:
+                    todo.append(d)
+            log.info(f"{len(rows) - len(todo)} probe-resultat återanvänds, {len(todo)} kvar")
+        todo = self._apply_cache(todo)
+
+        prefetch = getattr(self.hp, "prefetch_ping", None)
+        if prefetch:
+            prefetch([d["vars"].get("ansible_host", d["host"]) for d in todo])
+
+        if isinstance(self.hp, AsyncHostProbe):
+            def done(idx, res):
+                todo[idx]["result"] = res
+                if self.on_result:
+                    self.on_result(todo[idx])
+
+            self.hp.probe_many([(d["host"], d["vars"], d["user"], d["password"]) for d in todo], on_done=done)
+        elif todo:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as ex:
+                for f in as_completed([ex.submit(self._probe_row, d) for d in todo]):
+                    f.result()
+
+        if self.cache is not None:
+            for d in todo:
+                self.cache.put(d["result"])
+            self.cache.evict()
+            self.cache.save()
+        return {d["host"]: d for d in rows}
+
+    def _apply_cache(self, rows: List[Row]) -> List[Row]:
+        if self.cache is None:
+            return rows
+        todo = []
+        for d in rows:
+            ip = d["vars"].get("ansible_host", d["host"])
+            cached = self.cache.get(d["host"], ip, d["user"])
+            if cached is None:
+                todo.append(d)
+            else:
+                d["result"] = cached
+                if self.on_result:
+                    self.on_result(d)
+        log.info(f"Probe-cache: {len(rows) - len(todo)} färska, {len(todo)} att proba")
+        return todo
+
+    def _probe_row(self, d: Row) -> Row:
+        d["result"] = self.hp.probe(d["host"], d["vars"], d["user"], d["password"])
+        if self.on_result:
+            self.on_result(d)
+        return d
@@ -2,108 +2,381 @@
 # -*- coding: utf-8 -*-
 
 import os
+import glob
+import gzip
 import json
+import re
+import threading
 from datetime import datetime
-from openpyxl import Workbook
-from openpyxl.chart import PieChart, Reference, BarChart
-from openpyxl.styles import Font
+
+REPORTS_DIR = "reports"
+INDEX_FILE = "index.jsonl"
+# Nyaste formatet först; .json är det äldre formatet med hela modellen i ett dokument
+REPORT_SUFFIXES = (".jsonl.gz", ".json")
+_NAME_RE = re.compile(r"^[\w.-]+$")
+
+STATUSES = (("OK", "ok"), ("FAILED", "failed"), ("SKIPPED", "skipped"))
+
+
+def _new_counts():
+    return {"ok": 0, "failed": 0, "skipped": 0, "total": 0}
+
+
+def _count(counts, status):
+    for name, key in STATUSES:
+        if status == name:
+            counts[key] += 1
+    counts["total"] += 1
+
+
+def _probe_fields(probe, row):
+    return {
+        "ping_ok": bool(getattr(probe, "ping_ok", None)),
+        "ssh_ok": bool(getattr(probe, "ssh_ok", None)),
+        "ssh_login_ok": getattr(probe, "ssh_login_ok", None),
+        "used_user": getattr(probe, "used_user", None),
+        "autopatch_enabled": bool(row.get("autopatch_enabled", True)),
+        "freeipa_managed": bool(row.get("freeipa", False)),
+    }
+
+
+def write_xlsx(model, path):
+    """
+    Skriver Excel-rapporten från en rapportmodell (se ReportGenerator.build_model).
+    Använder openpyxl i write-only-läge: raderna strömmas till disk och hålls inte
+    kvar i minnet, så minnesåtgången är i stort sett oberoende av antalet värdar.
+    """
+    # openpyxl är tungt att importera; laddas först när en rapport faktiskt skrivs
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.chart import PieChart, Reference
+    from openpyxl.styles import Font
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Summary")
+
+    def styled(value, **font):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.font = Font(**font)
+        return cell
+
+    summary = model["summary"]
+    s, c = summary["standalone"], summary["clusters"]
+
+    # Rad 4 och 5 måste vara Standalone/Kluster: diagrammen nedan refererar dit
+    ws.append([styled(f"Autopatch rapport - {model['env']} ({model['run_id']})", size=14, bold=True)])
+    ws.append([])
+    ws.append(["Typ", "OK", "FAILED", "SKIPPED", "Totalt"])
+    ws.append(["Standalone", s["ok"], s["failed"], s["skipped"], s["total"]])
+    ws.append(["Kluster", c["ok"], c["failed"], c["skipped"], c["total"]])
+    ws.append([])
+    ws.append([])
+    ws.append([styled("Misslyckade standalone:", bold=True)])
+    for host in summary["failed_standalone"]:
+        ws.append([host])
+    ws.append([])
+    ws.append([styled("Misslyckade kluster:", bold=True)])
+    for cname in summary["failed_clusters"]:
+        ws.append([cname])
+
+    chart = PieChart()
+    chart.title = "Standalone resultat"
+    chart.add_data(Reference(ws, min_col=2, min_row=4, max_col=4), titles_from_data=False)
+    chart.set_categories(Reference(ws, min_col=1, min_row=4, max_row=4))
+    ws.add_chart(chart, "G3")
+
+    chart2 = PieChart()
+    chart2.title = "Kluster resultat"
+    chart2.add_data(Reference(ws, min_col=2, min_row=5, max_col=4), titles_from_data=False)
+    chart2.set_categories(Reference(ws, min_col=1, min_row=5, max_row=5))
+    ws.add_chart(chart2, "G18")
+
+    ws2 = wb.create_sheet("Standalone")
+    ws2.append([
+        "Host", "Ping", "SSH", "Login",
+        "Autopatch", "Status", "Duration",
+        "Reason", "Failed hosts"
+    ])
+    for item in model["standalone"]["items"]:
+        probe, patch = item["probe"], item["patch"]
+        ws2.append([
+            item["host"],
+            probe["ping_ok"],
+            probe["ssh_ok"],
+            probe["ssh_login_ok"],
+            probe["autopatch_enabled"],
+            patch["status"],
+            patch["duration"],
+            patch["reason"],
+            ",".join(patch["failed_hosts"]),
+        ])
+
+    ws3 = wb.create_sheet("Clusters")
+    ws3.append([
+        "Cluster", "Status", "Duration total",
+        "Reason", "Failed hosts", "Batch count"
+    ])
+    for co in model["clusters"]["summary"]:
+        ws3.append([
+            co["cluster"],
+            co["status"],
+            co["duration_total"],
+            co["reason"],
+            ",".join(co["failed_hosts"]),
+            len(co["batches"]),
+        ])
+
+    ws4 = wb.create_sheet("ClusterMembers")
+    ws4.append([
+        "Cluster", "Host", "Ping", "SSH",
+        "Login", "Autopatch"
+    ])
+    for m in model["clusters"]["members"]:
+        ws4.append([
+            m["cluster"],
+            m["host"],
+            m["ping_ok"],
+            m["ssh_ok"],
+            m["ssh_login_ok"],
+            m["autopatch_enabled"],
+        ])
+
+    # Daemonen kan rendera samma körning från flera trådar samtidigt
+    tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        wb.save(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return path
+
+
+def _strip_suffix(path):
+    for suffix in REPORT_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def find_report(run_id, env=None, reports_dir=REPORTS_DIR):
+    """Sökväg till rapporten för run_id (och env om flera miljöer har samma run_id)."""
+    for value in (run_id, env):
+        if value is not None and not _NAME_RE.match(value):
+            raise ValueError(f"ogiltigt namn: {value!r}")
+    for suffix in REPORT_SUFFIXES:
+        matches = sorted(glob.glob(os.path.join(reports_dir, f"autopatch_{env or '*'}_{run_id}{suffix}")))
+        if len(matches) > 1:
+            names = ", ".join(os.path.basename(m) for m in matches)
+            raise ValueError(f"flera rapporter för run_id {run_id} ({names}); ange env")
+        if matches:
+            return matches[0]
+    raise FileNotFoundError(f"ingen rapport för run_id {run_id} i {reports_dir}")
+
+
+def _report_records(model):
+    yield {"type": "run", **{k: model[k] for k in ("env", "run_id", "dry_run", "generated_at", "summary")}}
+    for item in model["standalone"]["items"]:
+        yield {"type": "standalone", **item}
+    for co in model["clusters"]["summary"]:
+        yield {"type": "cluster", **co}
+    for m in model["clusters"]["members"]:
+        yield {"type": "member", **m}
+
+
+def write_report(model, path):
+    """Skriver modellen som gzip-komprimerad JSONL: en run-post följd av en post per värd/kluster."""
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        for rec in _report_records(model):
+            f.write(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n")
+    os.replace(tmp, path)
+    return path
+
+
+def _summary_from_model(model):
+    s_counts, c_counts = _new_counts(), _new_counts()
+    for item in model["standalone"]["items"]:
+        _count(s_counts, item["patch"]["status"])
+    for co in model["clusters"]["summary"]:
+        _count(c_counts, co["status"])
+    return {
+        "standalone": s_counts,
+        "clusters": c_counts,
+        "failed_standalone": [i["host"] for i in model["standalone"]["items"] if i["patch"]["status"] == "FAILED"],
+        "failed_clusters": [co["cluster"] for co in model["clusters"]["summary"] if co["status"] == "FAILED"],
+    }
+
+
+def load_report(path):
+    """Läser en rapport i valfritt format och returnerar rapportmodellen."""
+    if not path.endswith(".jsonl.gz"):
+        with open(path, "r", encoding="utf-8") as f:
+            model = json.load(f)
+        if "summary" not in model:
+            model["summary"] = _summary_from_model(model)
+        return model
+
+    model = {"standalone": {"items": []}, "clusters": {"summary": [], "members": []}}
+    lists = {
+        "standalone": model["standalone"]["items"],
+        "cluster": model["clusters"]["summary"],
+        "member": model["clusters"]["members"],
+    }
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            kind = rec.pop("type", None)
+            if kind == "run":
+                model.update(rec)
+            elif kind in lists:
+                lists[kind].append(rec)
+    return model
+
+
+def append_index(model, report_path, reports_dir=REPORTS_DIR, started_at=None):
+    """Lägger till en rad per körning i reports/index.jsonl (append-only)."""
+    summary = model["summary"]
+    entry = {
+        "run_id": model["run_id"],
+        "env": model["env"],
+        "dry_run": model["dry_run"],
+        "started_at": started_at,
+        "finished_at": model["generated_at"],
+        "standalone": summary["standalone"],
+        "clusters": summary["clusters"],
+        "report": os.path.basename(report_path),
+    }
+    line = (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+    # En write() med O_APPEND: samtidiga körningar kan inte blanda ihop raderna
+    fd = os.open(os.path.join(reports_dir, INDEX_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+    return entry
+
+
+def read_index(reports_dir=REPORTS_DIR, env=None):
+    """Alla körningar i reports/index.jsonl (äldst först), valfritt filtrerat på env."""
+    entries = []
+    try:
+        with open(os.path.join(reports_dir, INDEX_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if env is None or entry.get("env") == env:
+                    entries.append(entry)
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def render_xlsx(run_id, env=None, reports_dir=REPORTS_DIR, force=False):
+    """
+    Skapar Excel-rapporten från rapportfilen vid första anrop och sparar den
+    bredvid den; senare anrop återanvänder den så länge den är nyare.
+    """
+    report_path = find_report(run_id, env=env, reports_dir=reports_dir)
+    xlsx_path = _strip_suffix(report_path) + ".xlsx"
+    if not force and os.path.exists(xlsx_path) and os.path.getmtime(xlsx_path) >= os.path.getmtime(report_path):
+        return xlsx_path
+    return write_xlsx(load_report(report_path), xlsx_path)
 
 
 class ReportGenerator:
-    def __init__(self, env: str, run_id: str, dry_run: bool):
+    def __init__(self, env: str, run_id: str, dry_run: bool, reports_dir: str = REPORTS_DIR):
         self.env = env
         self.run_id = run_id
         self.dry_run = dry_run
 
-        os.makedirs("reports", exist_ok=True)
-
-        self.xlsx_filename = f"reports/autopatch_{env}_{run_id}.xlsx"
-        self.json_filename = f"reports/autopatch_{env}_{run_id}.json"
+        os.makedirs(reports_dir, exist_ok=True)
 
-    @staticmethod
-    def _status_counts(items):
-        ok = sum(1 for x in items if x.status == "OK")
-        fail = sum(1 for x in items if x.status == "FAILED")
-        skip = sum(1 for x in items if x.status == "SKIPPED")
-        return ok, fail, skip, len(items)
+        self.reports_dir = reports_dir
+        self.xlsx_filename = f"{reports_dir}/autopatch_{env}_{run_id}.xlsx"
+        self.report_filename = f"{reports_dir}/autopatch_{env}_{run_id}.jsonl.gz"
 
     @staticmethod
-    def _join_failed_hosts(value):
+    def _host_list(value):
         if not value:
-            return ""
+            return []
+        if isinstance(value, str):
+            return [value]
         try:
-            return ",".join(str(v) for v in value)
+            return [str(v) for v in value]
         except TypeError:
-            return str(value)
+            return [str(value)]
 
-    def _build_json_payload(self, standalone_outcomes, cluster_outcomes,
-                            standalone_probe, cluster_probe):
+    def build_model(self, standalone_outcomes, cluster_outcomes,
+                    standalone_probe, cluster_probe):
+        """
+        Bygger rapportmodellen i ett svep över utfall och probe-rader.
+        Modellen är underlaget både för rapportfilen och för Excel-rapporten.
+        """
+        s_counts, c_counts = _new_counts(), _new_counts()
+        failed_standalone, failed_clusters = [], []
 
         s_index = {o.host: o for o in standalone_outcomes}
-
         standalone_list = []
         for row in standalone_probe:
-            probe = row["result"]
             outcome = s_index.get(row["host"])
             if not outcome:
                 continue
+            probe = row["result"]
+            _count(s_counts, outcome.status)
+            if outcome.status == "FAILED":
+                failed_standalone.append(probe.host)
             standalone_list.append({
                 "host": probe.host,
-                "probe": {
-                    "ping_ok": bool(getattr(probe, "ping_ok", None)),
-                    "ssh_ok": bool(getattr(probe, "ssh_ok", None)),
-                    "ssh_login_ok": getattr(probe, "ssh_login_ok", None),
-                    "used_user": getattr(probe, "used_user", None),
-                    "autopatch_enabled": bool(row.get("autopatch_enabled", True)),
-                    "freeipa_managed": bool(row.get("freeipa", False)),
-                },
+                "probe": _probe_fields(probe, row),
                 "patch": {
                     "status": outcome.status,
                     "reason": outcome.reason,
                     "duration": outcome.duration,
-                    "failed_hosts": list(getattr(outcome, "failed_hosts", []) or []),
+                    "batch_duration": getattr(outcome, "batch_duration", None),
+                    "failed_hosts": self._host_list(getattr(outcome, "failed_hosts", None)),
+                    "task_timings": list(getattr(outcome, "task_timings", None) or []),
                 },
             })
 
         cluster_summary = []
         for co in cluster_outcomes:
-            batch_list = []
-            for b in (co.batch_results or []):
-                user, dur, fh = b
-                batch_list.append({
-                    "user": user,
-                    "duration": dur,
-                    "failed_hosts": list(fh or []),
-                })
+            _count(c_counts, co.status)
+            if co.status == "FAILED":
+                failed_clusters.append(co.cluster)
             cluster_summary.append({
                 "cluster": co.cluster,
                 "status": co.status,
                 "reason": co.reason,
                 "duration_total": co.duration_total,
-                "failed_hosts": list(co.failed_hosts or []),
-                "batches": batch_list,
+                "failed_hosts": self._host_list(co.failed_hosts),
+                "batches": [
+                    {"user": user, "duration": dur, "failed_hosts": list(fh or [])}
+                    for user, dur, fh in (co.batch_results or [])
+                ],
+                "task_timings": dict(getattr(co, "task_timings", None) or {}),
             })
 
         cluster_members = []
         for cname, rows in cluster_probe.items():
             for row in rows:
                 probe = row["result"]
-                cluster_members.append({
-                    "cluster": cname,
-                    "host": probe.host,
-                    "ping_ok": bool(getattr(probe, "ping_ok", None)),
-                    "ssh_ok": bool(getattr(probe, "ssh_ok", None)),
-                    "ssh_login_ok": getattr(probe, "ssh_login_ok", None),
-                    "used_user": getattr(probe, "used_user", None),
-                    "autopatch_enabled": bool(row.get("autopatch_enabled", True)),
-                    "freeipa_managed": bool(row.get("freeipa", False)),
-                })
-
-        payload = {
+                cluster_members.append({"cluster": cname, "host": probe.host, **_probe_fields(probe, row)})
+
+        return {
             "env": self.env,
             "run_id": self.run_id,
             "dry_run": self.dry_run,
             "generated_at": datetime.utcnow().isoformat() + "Z",
+            "summary": {
+                "standalone": s_counts,
+                "clusters": c_counts,
+                "failed_standalone": failed_standalone,
+                "failed_clusters": failed_clusters,
+            },
             "standalone": {
                 "items": standalone_list,
             },
@@ -112,135 +385,27 @@ class ReportGenerator:
                 "members": cluster_members,
             },
         }
-        return payload
 
     def generate(self, standalone_outcomes, cluster_outcomes,
-                 standalone_probe, cluster_probe):
-        
-        wb = Workbook()
-
-        ws = wb.active
-        ws.title = "Summary"
-
-        ws["A1"] = f"Autopatch rapport - {self.env} ({self.run_id})"
-        ws["A1"].font = Font(size=14, bold=True)
-
-        ws["A3"] = "Typ"
-        ws["B3"] = "OK"
-        ws["C3"] = "FAILED"
-        ws["D3"] = "SKIPPED"
-        ws["E3"] = "Totalt"
-
-        s_ok, s_fail, s_skip, s_total = self._status_counts(standalone_outcomes)
-        c_ok, c_fail, c_skip, c_total = self._status_counts(cluster_outcomes)
-
-        ws.append(["Standalone", s_ok, s_fail, s_skip, s_total])
-        ws.append(["Kluster", c_ok, c_fail, c_skip, c_total])
-
-        row = 8
-        ws[f"A{row}"] = "Misslyckade standalone:"
-        ws[f"A{row}"].font = Font(bold=True)
-        row += 1
-        for o in standalone_outcomes:
-            if o.status == "FAILED":
-                ws[f"A{row}"] = o.host
-                row += 1
-
-        row += 1
-        ws[f"A{row}"] = "Misslyckade kluster:"
-        ws[f"A{row}"].font = Font(bold=True)
-        row += 1
-        for o in cluster_outcomes:
-            if o.status == "FAILED":
-                ws[f"A{row}"] = o.cluster
-                row += 1
-
-        chart = PieChart()
-        chart.title = "Standalone resultat"
-        labels = Reference(ws, min_col=1, min_row=4, max_row=4)
-        data = Reference(ws, min_col=2, min_row=4, max_col=4)
-        chart.add_data(data, titles_from_data=False)
-        chart.set_categories(labels)
-        ws.add_chart(chart, "G3")
-
-        chart2 = PieChart()
-        chart2.title = "Kluster resultat"
-        labels2 = Reference(ws, min_col=1, min_row=5, max_row=5)
-        data2 = Reference(ws, min_col=2, min_row=5, max_col=4)
-        chart2.add_data(data2, titles_from_data=False)
-        chart2.set_categories(labels2)
-        ws.add_chart(chart2, "G18")
-
-        ws2 = wb.create_sheet("Standalone")
-        ws2.append([
-            "Host", "Ping", "SSH", "Login",
-            "Autopatch", "Status", "Duration",
-            "Reason", "Failed hosts"
-        ])
-
-        s_index = {o.host: o for o in standalone_outcomes}
-
-        for r in standalone_probe:
-            outcome = s_index.get(r["host"])
-            if not outcome:
-                continue
-            probe = r["result"]
-
-            ws2.append([
-                probe.host,
-                bool(getattr(probe, "ping_ok", None)),
-                bool(getattr(probe, "ssh_ok", None)),
-                getattr(probe, "ssh_login_ok", None),
-                bool(r.get("autopatch_enabled", True)),
-                outcome.status,
-                outcome.duration,
-                outcome.reason,
-                self._join_failed_hosts(getattr(outcome, "failed_hosts", None)),
-            ])
-
-        ws3 = wb.create_sheet("Clusters")
-        ws3.append([
-            "Cluster", "Status", "Duration total",
-            "Reason", "Failed hosts", "Batch count"
-        ])
-
-        for co in cluster_outcomes:
-            ws3.append([
-                co.cluster,
-                co.status,
-                co.duration_total,
-                co.reason,
-                self._join_failed_hosts(co.failed_hosts),
-                len(co.batch_results or []),
-            ])
-
-        ws4 = wb.create_sheet("ClusterMembers")
-        ws4.append([
-            "Cluster", "Host", "Ping", "SSH",
-            "Login", "Autopatch"
-        ])
-
-        for cname, rows in cluster_probe.items():
-            for r in rows:
-                probe = r["result"]
-                ws4.append([
-                    cname,
-                    probe.host,
-                    bool(getattr(probe, "ping_ok", None)),
-                    bool(getattr(probe, "ssh_ok", None)),
-                    getattr(probe, "ssh_login_ok", None),
-                    bool(r.get("autopatch_enabled", True)),
-                ])
-
-        wb.save(self.xlsx_filename)
-
-        payload = self._build_json_payload(
+                 standalone_probe, cluster_probe, xlsx=False, started_at=None, history=None):
+        """
+        Skriver rapporten (gzip JSONL, primär artefakt), lägger till körningen i
+        reports/index.jsonl och returnerar skrivna filer. Excel-rapporten skapas
+        bara om xlsx=True; annars vid behov via render_xlsx(). Med history
+        (RunHistory) sparas körningen även i historikdatabasen.
+        """
+        model = self.build_model(
             standalone_outcomes=standalone_outcomes,
             cluster_outcomes=cluster_outcomes,
             standalone_probe=standalone_probe,
             cluster_probe=cluster_probe,
         )
-        with open(self.json_filename, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2)
 
-        return self.xlsx_filename, self.json_filename
+        files = [write_report(model, self.report_filename)]
+        append_index(model, self.report_filename, reports_dir=self.reports_dir, started_at=started_at)
+        if history is not None:
+            history.record_run(model, started_at=started_at)
+
+        if xlsx:
+            files.append(write_xlsx(model, self.xlsx_filename))
+        return files
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import math
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    env TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    dry_run INTEGER NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    standalone_ok INTEGER, standalone_failed INTEGER, standalone_skipped INTEGER,
+    clusters_ok INTEGER, clusters_failed INTEGER, clusters_skipped INTEGER,
+    PRIMARY KEY (env, run_id)
+);
+CREATE TABLE IF NOT EXISTS probes (
+    env TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    host TEXT NOT NULL,
+    cluster TEXT NOT NULL DEFAULT '',
+    ping_ok INTEGER, ssh_ok INTEGER, ssh_login_ok INTEGER,
+    used_user TEXT,
+    autopatch_enabled INTEGER,
+    PRIMARY KEY (env, run_id, host, cluster)
+);
+CREATE TABLE IF NOT EXISTS host_outcomes (
+    env TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    host TEXT NOT NULL,
+    status TEXT NOT NULL,
+    reason TEXT,
+    duration REAL,
+    user TEXT,
+    failed_hosts TEXT,
+    PRIMARY KEY (env, run_id, host)
+);
+CREATE TABLE IF NOT EXISTS cluster_outcomes (
+    env TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    cluster TEXT NOT NULL,
+    status TEXT NOT NULL,
+    reason TEXT,
+    duration_total REAL,
+    failed_hosts TEXT,
+    PRIMARY KEY (env, run_id, cluster)
+);
+CREATE TABLE IF NOT EXISTS batches (
+    env TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    cluster TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    user TEXT,
+    duration REAL,
+    failed_hosts TEXT,
+    PRIMARY KEY (env, run_id, cluster, seq)
+);
+CREATE INDEX IF NOT EXISTS host_outcomes_by_host ON host_outcomes (env, host, run_id);
+CREATE INDEX IF NOT EXISTS cluster_outcomes_by_cluster ON cluster_outcomes (env, cluster, run_id);
+CREATE INDEX IF NOT EXISTS probes_by_host ON probes (env, host, run_id);
+"""
+
+# (tabell, namnkolumn, durationskolumn) för värdar respektive kluster
+_TARGETS = {
+    False: ("host_outcomes", "host", "duration"),
+    True: ("cluster_outcomes", "cluster", "duration_total"),
+}
+
+
+def _bool(value: Any) -> Optional[int]:
+    return None if value is None else int(bool(value))
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """Percentil med linjär interpolation (som numpy.percentile); values måste vara sorterade."""
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    lo, hi = math.floor(k), math.ceil(k)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class RunHistory:
+    """
+    Körhistorik i SQLite (WAL): probe-resultat, utfall per värd och kluster samt
+    batchar, nycklade på env + run_id + värd/kluster. Varje körning skrivs i en
+    transaktion; frågehjälparna läser bara de senaste körningarna per värd.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self.conn.executescript(SCHEMA)
+
+    def _migrate(self) -> None:
+        """
+        Äldre databaser har probes nycklad på (env, run_id, host), vilket inte
+        rymmer en värd som ingår i flera kluster. Tabellen byggs om med cluster
+        i nyckeln ('' för standalone).
+        """
+        pk = {row[1] for row in self.conn.execute("PRAGMA table_info(probes)") if row[5]}
+        if not pk or "cluster" in pk:
+            return
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DROP INDEX IF EXISTS probes_by_host")
+            self.conn.execute("ALTER TABLE probes RENAME TO probes_old")
+            for statement in SCHEMA.split(";"):
+                if "probes" in statement:
+                    self.conn.execute(statement)
+            self.conn.execute(
+                "INSERT OR IGNORE INTO probes SELECT env, run_id, host, COALESCE(cluster, ''), ping_ok, ssh_ok, "
+                "ssh_login_ok, used_user, autopatch_enabled FROM probes_old"
+            )
+            self.conn.execute("DROP TABLE probes_old")
+        log.info(f"Körhistorik {self.path}: probes har cluster i nyckeln")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record_run(self, model: Dict[str, Any], started_at: Optional[str] = None) -> bool:
+        """
+        Skriver en hel körning (rapportmodellen från ReportGenerator) i en
+        transaktion. Ett databasfel loggas som varning och ger False; rapporten
+        är redan skriven och körningen ska inte avbrytas av historiken.
+        """
+        env, run_id = model["env"], model["run_id"]
+        s, c = model["summary"]["standalone"], model["summary"]["clusters"]
+        items = model["standalone"]["items"]
+        clusters = model["clusters"]["summary"]
+
+        probes = [
+            (env, run_id, i["host"], "", _bool(i["probe"]["ping_ok"]), _bool(i["probe"]["ssh_ok"]),
+             _bool(i["probe"]["ssh_login_ok"]), i["probe"]["used_user"], _bool(i["probe"]["autopatch_enabled"]))
+            for i in items
+        ] + [
+            (env, run_id, m["host"], m["cluster"], _bool(m["ping_ok"]), _bool(m["ssh_ok"]),
+             _bool(m["ssh_login_ok"]), m["used_user"], _bool(m["autopatch_enabled"]))
+            for m in model["clusters"]["members"]
+        ]
+        hosts = [
+            (env, run_id, i["host"], i["patch"]["status"], i["patch"]["reason"], i["patch"]["duration"],
+             i["probe"]["used_user"], json.dumps(i["patch"]["failed_hosts"]))
+            for i in items
+        ]
+        cluster_rows = [
+            (env, run_id, co["cluster"], co["status"], co["reason"], co["duration_total"],
+             json.dumps(co["failed_hosts"]))
+            for co in clusters
+        ]
+        batches = [
+            (env, run_id, co["cluster"], seq, b["user"], b["duration"], json.dumps(b["failed_hosts"]))
+            for co in clusters
+            for seq, b in enumerate(co["batches"])
+        ]
+
+        try:
+            with self.conn:
+                # En omkörd run_id (t.ex. --resume) ersätter tidigare rader för körningen
+                for table in ("probes", "host_outcomes", "cluster_outcomes", "batches"):
+                    self.conn.execute(f"DELETE FROM {table} WHERE env = ? AND run_id = ?", (env, run_id))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (env, run_id, int(bool(model["dry_run"])), started_at, model["generated_at"],
+                     s["ok"], s["failed"], s["skipped"], c["ok"], c["failed"], c["skipped"]),
+                )
+                self.conn.executemany("INSERT INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", probes)
+                self.conn.executemany("INSERT INTO host_outcomes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", hosts)
+                self.conn.executemany("INSERT INTO cluster_outcomes VALUES (?, ?, ?, ?, ?, ?, ?)", cluster_rows)
+                self.conn.executemany("INSERT INTO batches VALUES (?, ?, ?, ?, ?, ?, ?)", batches)
+        except sqlite3.Error as e:
+            log.warning(f"Kunde inte spara körhistorik {run_id} i {self.path}: {e}")
+            return False
+        log.info(f"Körhistorik {run_id} sparad i {self.path} ({len(hosts)} värdar, {len(cluster_rows)} kluster)")
+        return True
+
+    def recent_durations(self, env: str, last: int = 30, clusters: bool = False,
+                         names: Optional[Iterable[str]] = None) -> Dict[str, List[float]]:
+        """
+        Patchtider för de senaste `last` körningarna per värd (eller kluster),
+        nyast först. SKIPPED räknas inte: de har ingen patchtid. Inte heller
+        --dry-run-körningar, som är mycket kortare än riktig patchning.
+        """
+        table, col, dur = _TARGETS[clusters]
+        rows = self.conn.execute(
+            f"""
+            SELECT name, d FROM (
+                SELECT t.{col} AS name, t.{dur} AS d,
+                       ROW_NUMBER() OVER (PARTITION BY t.{col} ORDER BY t.run_id DESC) AS n
+                FROM {table} t JOIN runs r ON r.env = t.env AND r.run_id = t.run_id
+                WHERE t.env = ? AND r.dry_run = 0 AND t.status != 'SKIPPED' AND t.{dur} IS NOT NULL
+            ) WHERE n <= ? ORDER BY name, n
+            """,
+            (env, int(last)),
+        )
+        wanted = set(names) if names is not None else None
+        out: Dict[str, List[float]] = {}
+        for name, d in rows:
+            if wanted is None or name in wanted:
+                out.setdefault(name, []).append(d)
+        return out
+
+    def duration_percentiles(self, env: str, percentiles: Sequence[float] = (50, 90, 99), last: int = 30,
+                             clusters: bool = False,
+                             names: Optional[Iterable[str]] = None) -> Dict[str, Dict[str, float]]:
+        """{namn: {"p50": .., "p90": .., "runs": n}} över de senaste `last` körningarna."""
+        out = {}
+        for name, values in self.recent_durations(env, last=last, clusters=clusters, names=names).items():
+            values = sorted(values)
+            stats = {f"p{p:g}": percentile(values, p) for p in percentiles}
+            stats["runs"] = len(values)
+            out[name] = stats
+        return out
+
+    def failure_streaks(self, env: str, min_streak: int = 2, clusters: bool = False) -> Dict[str, int]:
+        """
+        Antal FAILED i rad sedan senaste OK per värd (eller kluster), för dem med
+        minst min_streak. SKIPPED (ej nåbar/autopatch av) bryter inte en svit.
+        """
+        table, col, _ = _TARGETS[clusters]
+        rows = self.conn.execute(
+            f"""
+            SELECT t.{col}, COUNT(*) FROM {table} t
+            WHERE t.env = ? AND t.status = 'FAILED'
+              AND t.run_id > COALESCE((SELECT MAX(o.run_id) FROM {table} o
+                                       WHERE o.env = t.env AND o.{col} = t.{col} AND o.status = 'OK'), '')
+            GROUP BY t.{col}
+            HAVING COUNT(*) >= ?
+            ORDER BY COUNT(*) DESC, t.{col}
+            """,
+            (env, int(min_streak)),
+        )
+        return {name: n for name, n in rows}
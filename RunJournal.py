@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict
+
+from HostProbe import ProbeResult
+from Helper import HostOutcome, ClusterOutcome
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class JournalState:
+    """Det som en avbruten körning hann med, återskapat ur journalen."""
+    start: Dict[str, Any] = field(default_factory=dict)
+    probes: Dict[str, ProbeResult] = field(default_factory=dict)
+    standalone: Dict[str, HostOutcome] = field(default_factory=dict)
+    clusters: Dict[str, ClusterOutcome] = field(default_factory=dict)
+    finished: bool = False
+
+
+class RunJournal:
+    """
+    Append-only journal (JSONL) för en körning: start, varje probe-resultat och
+    varje standalone-/klusterutfall när det blir klart. Utfallsposter fsyncas
+    direkt; probe-poster flushas och fsyncas samlat via sync() efter probe-fasen,
+    så att tusentals prober inte kostar en fsync var. Lösenord journalförs aldrig.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fh = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def path_for(journal_dir: str, run_id: str) -> str:
+        return os.path.join(journal_dir, f"{run_id}.jsonl")
+
+    def _write(self, rec: Dict[str, Any], sync: bool = True) -> None:
+        line = json.dumps(rec, ensure_ascii=False, separators=(",", ":"), default=str) + "\n"
+        with self._lock:
+            self._fh.write(line)
+            self._fh.flush()
+            if sync:
+                os.fsync(self._fh.fileno())
+
+    def sync(self) -> None:
+        with self._lock:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def start(self, run_id: str, env: str, dry_run: bool, started_at: str, resumed: bool = False) -> None:
+        self._write({"type": "resume" if resumed else "start", "run_id": run_id, "env": env,
+                     "dry_run": dry_run, "started_at": started_at, "ts": time.time()})
+
+    def probe(self, row: Dict[str, Any]) -> None:
+        self._write({"type": "probe", **asdict(row["result"])}, sync=False)
+
+    def outcome(self, outcome) -> None:
+        if isinstance(outcome, ClusterOutcome):
+            self._write({"type": "cluster", **asdict(outcome)})
+        else:
+            self._write({"type": "standalone", **asdict(outcome)})
+
+    def finish(self) -> None:
+        self._write({"type": "end", "ts": time.time()})
+
+    def close(self) -> None:
+        with self._lock:
+            self._fh.close()
+
+    @staticmethod
+    def replay(path: str) -> JournalState:
+        """Läser journalen; en avhuggen sista rad (krasch mitt i en skrivning) ignoreras."""
+        state = JournalState()
+        with open(path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    log.warning(f"Journal {path}: hoppar över trasig rad {line_no}")
+                    continue
+                kind = rec.pop("type", None)
+                if kind == "start":
+                    state.start = rec
+                elif kind == "probe":
+                    state.probes[rec["host"]] = ProbeResult(**rec)
+                elif kind == "standalone":
+                    state.standalone[rec["host"]] = HostOutcome(**rec)
+                elif kind == "cluster":
+                    rec["batch_results"] = [tuple(b) for b in rec.get("batch_results") or []]
+                    state.clusters[rec["cluster"]] = ClusterOutcome(**rec)
+                elif kind == "end":
+                    state.finished = True
+        return state
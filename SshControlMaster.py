@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class SshControlMaster:
+    """
+    Delade SSH ControlMaster-sessioner mellan probe och patch.
+
+    HostProbe öppnar en master-socket per värd vid ssh-login; PlaybookExecutor
+    pekar ansible-playbook mot samma ControlPath så att nyckelutbyte och
+    PAM/FreeIPA-autentisering bara görs en gång per värd och körning.
+    close() stänger alla masters och tar bort socket-katalogen.
+    """
+
+    def __init__(self, control_dir: Optional[str] = None, persist: int = 900):
+        self._owns_dir = control_dir is None
+        self.control_dir = control_dir or tempfile.mkdtemp(prefix="autopatch-cm-")
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        self.persist = int(persist)
+        self._masters: Set[Tuple[str, str]] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def control_path(self) -> str:
+        # %C = hash av lokal värd, fjärrvärd, port och användare (samma för ssh och ansible)
+        return os.path.join(self.control_dir, "%C")
+
+    def ssh_options(self) -> List[str]:
+        return [
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPath={self.control_path}",
+            "-o", f"ControlPersist={self.persist}",
+        ]
+
+    def ansible_ssh_common_args(self) -> str:
+        return " ".join(self.ssh_options())
+
+    def ansible_env(self) -> Dict[str, str]:
+        # ansible kör control_path genom %-formattering, därav %%C
+        return {
+            "ANSIBLE_SSH_CONTROL_PATH_DIR": self.control_dir,
+            "ANSIBLE_SSH_CONTROL_PATH": self.control_path.replace("%", "%%"),
+        }
+
+    def register(self, user: str, ip: str) -> None:
+        with self._lock:
+            self._masters.add((user, ip))
+
+    def close(self) -> None:
+        with self._lock:
+            masters = sorted(self._masters)
+            self._masters.clear()
+        for user, ip in masters:
+            try:
+                subprocess.run(
+                    ["ssh", "-o", f"ControlPath={self.control_path}", "-O", "exit", f"{user}@{ip}"],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10,
+                )
+            except (OSError, subprocess.SubprocessError) as e:
+                log.debug(f"ControlMaster exit {user}@{ip} -> {e}")
+        if self._owns_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+        log.info(f"Stängde {len(masters)} SSH ControlMaster-sessioner")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lokal ersättare för ansible-playbook: tar samma argument som PlaybookExecutor
+skickar (-i, playbook, -l, --extra-vars, --forks, --check ...) och skriver
+realistisk utdata (PLAY/TASK-rubriker, ok/changed/skipping, fatal FAILED! och
+UNREACHABLE!, ...ignoring och PLAY RECAP) med konfigurerbar felfrekvens och
+tidsåtgång, utan nätverk. Utfallet per värd är deterministiskt (--seed + värdnamn).
+
+    AUTOPATCH_ANSIBLE_PLAYBOOK="python3 benchmarks/fake_ansible_playbook.py --fail-rate 0.05" \\
+        python3 main.py --env qa
+    python benchmarks/fake_ansible_playbook.py --fake-hosts 500 --result-bytes 400 > out.log
+
+Med --events skrivs även autopatch_events-händelser (play_start, host_task och stats) till
+AUTOPATCH_EVENTS_FILE, som den riktiga callbacken; annars används textskanningen.
+Returkod som ansible-playbook: 2 vid misslyckade värdar, 4 om bara onåbara, annars 0.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+PLAYBOOK_TASKS = (
+    ("Gathering Facts", "gather_facts"),
+    ("Uppdatera paketcache", "ansible.builtin.dnf"),
+    ("Installera uppdateringar", "ansible.builtin.dnf"),
+    ("Kontrollera om omstart krävs", "ansible.builtin.command"),
+    ("Starta om värden", "ansible.builtin.reboot"),
+    ("Vänta på att värden svarar", "ansible.builtin.wait_for_connection"),
+    ("Verifiera tjänster", "ansible.builtin.service_facts"),
+)
+# Tasks som kan misslyckas med ignore_errors: true (räknas inte som fel)
+IGNORABLE = {"Kontrollera om omstart krävs"}
+
+
+def header(kind: str, name=None) -> str:
+    title = f"{kind} [{name}] " if name is not None else f"{kind} "
+    return title + "*" * max(3, 79 - len(title))
+
+
+def host_fate(seed: int, host: str, fail_rate: float, unreachable_rate: float, ignore_rate: float):
+    """(onåbar, index för task som failar eller None, ignorerat fel) för en värd."""
+    rng = random.Random(f"{seed}:{host}")
+    if rng.random() < unreachable_rate:
+        return True, None, False
+    fail_at = rng.randrange(1, len(PLAYBOOK_TASKS)) if rng.random() < fail_rate else None
+    return False, fail_at, rng.random() < ignore_rate
+
+
+def _payload(rng: random.Random, size: int, changed: bool) -> str:
+    """Ungefär `size` tecken modulresultat, som med -v."""
+    lines, total = [], 0
+    while total < size:
+        line = f"Installed: pkg{rng.randrange(1000):03d}-{rng.randrange(10)}.{rng.randrange(40)}-1.el9.x86_64"
+        lines.append(line)
+        total += len(line) + 4
+    return json.dumps({"changed": changed, "msg": "", "rc": 0, "results": lines}, ensure_ascii=False)
+
+
+def emit(hosts, opts, out=sys.stdout, err=sys.stderr, events=None, sleep=time.sleep):
+    """
+    Skriver en hel playbook-körning för `hosts` till out/err och returnerar
+    (rc, misslyckade värdar i den ordning de rapporterades). `events` är en
+    öppen fil för autopatch_events-händelser eller None.
+    """
+    rng = random.Random(opts.seed)
+    fates = {h: host_fate(opts.seed, h, opts.fail_rate, opts.unreachable_rate, opts.ignore_rate) for h in hosts}
+    stats = {h: {"ok": 0, "changed": 0, "unreachable": 0, "failures": 0, "skipped": 0,
+                 "rescued": 0, "ignored": 0} for h in hosts}
+    failed, unreachable, reported = [], [], {}
+    active = list(hosts)
+
+    for _ in range(opts.stderr_warnings):
+        err.write("[WARNING]: Invalid characters were found in group names but not replaced, use -vvvv to see details\n")
+    if opts.startup_ms:
+        sleep(opts.startup_ms / 1000.0)
+
+    out.write(header("PLAY", opts.play) + "\n\n")
+    if events is not None:
+        events.write(json.dumps({"event": "play_start", "play": opts.play,
+                                 "last_task": PLAYBOOK_TASKS[-1][0], "ts": time.time()}) + "\n")
+    for idx, (task, action) in enumerate(PLAYBOOK_TASKS):
+        if not active:
+            out.write(header("NO MORE HOSTS LEFT") + "\n\n")
+            break
+        out.write(header("TASK", task) + "\n")
+        if opts.task_ms:
+            sleep(opts.task_ms * (1 + rng.uniform(-opts.jitter, opts.jitter)) / 1000.0)
+
+        # Resultaten kommer i den ordning värdarna blir klara, inte inventory-ordning
+        order = list(active)
+        rng.shuffle(order)
+        for host in order:
+            gone, fail_at, ignore = fates[host]
+            s = stats[host]
+            status, ignored = None, False
+            if idx == 0 and gone:
+                out.write(f'fatal: [{host}]: UNREACHABLE! => {{"changed": false, "msg": "Failed to connect to '
+                          f'the host via ssh: ssh: connect to host {host} port 22: Connection timed out", '
+                          f'"unreachable": true}}\n')
+                s["unreachable"] += 1
+                unreachable.append(host)
+                reported.setdefault(host)
+                status = "unreachable"
+            elif fail_at == idx:
+                if rng.random() < 0.3:
+                    msg = ('"module_stderr": "Shared connection closed.\\r\\n", "module_stdout": "", '
+                           '"msg": "MODULE FAILURE\\nSee stdout/stderr for the exact error", "rc": 1')
+                else:
+                    msg = ('"msg": "Depsolve Error occurred: \\n Problem: cannot install the best update '
+                           'candidate for package", "rc": 1, "results": []')
+                out.write(f'fatal: [{host}]: FAILED! => {{"changed": false, {msg}}}\n')
+                s["failures"] += 1
+                failed.append(host)
+                reported.setdefault(host)
+                status = "failed"
+            elif ignore and task in IGNORABLE:
+                out.write(f'fatal: [{host}]: FAILED! => {{"changed": false, "cmd": ["needs-restarting", "-r"], '
+                          f'"msg": "non-zero return code", "rc": 1}}\n...ignoring\n')
+                s["ignored"] += 1
+                status, ignored = "failed", True
+            elif opts.check and action == "ansible.builtin.reboot":
+                out.write(f"skipping: [{host}]\n")
+                s["skipped"] += 1
+                status = "skipped"
+            else:
+                changed = action == "ansible.builtin.dnf" and rng.random() < 0.6
+                status = "changed" if changed else "ok"
+                verbose = opts.result_bytes and action != "gather_facts"
+                payload = f" => {_payload(rng, opts.result_bytes, changed)}" if verbose else ""
+                out.write(f"{status}: [{host}]{payload}\n")
+                s["ok"] += 1
+                s["changed"] += int(changed)
+            if events is not None:
+                events.write(json.dumps({"event": "host_task", "host": host, "task": task, "action": action,
+                                         "status": status, "ignore_errors": ignored,
+                                         "duration": round(opts.task_ms / 1000.0, 3)}) + "\n")
+        active = [h for h in active if h not in reported]
+        out.write("\n")
+        out.flush()
+
+    out.write(header("PLAY RECAP") + "\n")
+    for host in sorted(hosts):
+        s = stats[host]
+        out.write(f"{host:<26} : ok={s['ok']:<4} changed={s['changed']:<4} unreachable={s['unreachable']:<4} "
+                  f"failed={s['failures']:<4} skipped={s['skipped']:<4} rescued={s['rescued']:<4} "
+                  f"ignored={s['ignored']:<4}\n")
+    out.write("\n")
+    out.flush()
+    if events is not None:
+        events.write(json.dumps({"event": "stats", "hosts": stats, "ts": time.time()}) + "\n")
+
+    rc = 2 if failed else 4 if unreachable else 0
+    return rc, list(reported)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fejkad ansible-playbook för benchmarks och lokala tester")
+    # Argument som PlaybookExecutor skickar; bara -l och --check påverkar utdata
+    parser.add_argument("playbook", nargs="?", default="patch.yml")
+    parser.add_argument("-i", "--inventory")
+    parser.add_argument("-l", "--limit", default="")
+    parser.add_argument("-e", "--extra-vars", action="append")
+    parser.add_argument("-f", "--forks", type=int)
+    parser.add_argument("--ssh-common-args")
+    parser.add_argument("-C", "--check", action="store_true")
+    # Simuleringen
+    parser.add_argument("--fake-hosts", type=int, default=0,
+                        help="generera N värdnamn när -l saknas (för att skapa utdata fristående)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fail-rate", type=float, default=0.02, help="andel värdar som failar en task")
+    parser.add_argument("--unreachable-rate", type=float, default=0.01, help="andel onåbara värdar")
+    parser.add_argument("--ignore-rate", type=float, default=0.1, help="andel med ignorerat fel (...ignoring)")
+    parser.add_argument("--result-bytes", type=int, default=0,
+                        help="ungefärlig storlek på modulresultat per ok/changed-rad (som -v)")
+    parser.add_argument("--task-ms", type=float, default=0.0, help="tid per task i ms")
+    parser.add_argument("--startup-ms", type=float, default=0.0, help="uppstartstid innan första PLAY")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relativ spridning på --task-ms")
+    parser.add_argument("--stderr-warnings", type=int, default=1, help="antal [WARNING]-rader på stderr")
+    parser.add_argument("--events", action="store_true",
+                        help="skriv autopatch_events-händelser till AUTOPATCH_EVENTS_FILE")
+    parser.add_argument("--play", default="Patcha värdar")
+    args, _unknown = parser.parse_known_args(argv)
+    return args
+
+
+def main(argv=None) -> int:
+    opts = parse_args(argv)
+    hosts = [h for h in opts.limit.split(",") if h]
+    if not hosts:
+        hosts = [f"srv{i:05d}.sim" for i in range(opts.fake_hosts)]
+    if not hosts:
+        sys.stderr.write("ERROR! Specified hosts and/or --limit does not match any hosts\n")
+        return 1
+
+    events_path = os.environ.get("AUTOPATCH_EVENTS_FILE") if opts.events else None
+    events = open(events_path, "a", encoding="utf-8") if events_path else None
+    try:
+        rc, _failed = emit(hosts, opts, events=events)
+    finally:
+        if events is not None:
+            events.close()
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())
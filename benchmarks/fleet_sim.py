@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Simulerad flotta för att mäta autopatchs egen overhead utan nätverk.
+
+Genererar ett syntetiskt inventory (N värdar, C kluster), kör hela flödet
+(inventory -> probe -> patch -> rapport) med riktiga AnsibleInventory,
+ProbeScheduler, Helper och ReportGenerator men med fejkade HostProbe- och
+PlaybookExecutor-backends som har konfigurerbar latens och felfrekvens.
+Rapporterar väggklocktid per fas, peak RSS och genomströmning.
+
+    python benchmarks/fleet_sim.py                       # 100, 1k och 10k värdar
+    python benchmarks/fleet_sim.py --hosts 1000 --probe-engine async --pipeline
+    python benchmarks/fleet_sim.py --hosts 10000 --time-scale 0 --json out.json
+
+Varje storlek körs i en egen process så att peak RSS gäller just den storleken.
+Kräver ansible-core (för inventory-fasen) och openpyxl endast med --xlsx.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from AnsibleInventory import AnsibleInventory  # noqa: E402
+from HostProbe import HostProbe, AsyncHostProbe, ProbeResult  # noqa: E402
+from PlaybookExecutor import PlaybookExecutor, PlaybookResult  # noqa: E402
+from ProbeScheduler import ProbeScheduler  # noqa: E402
+from Helper import Helper, PatchPipeline  # noqa: E402
+from ReportGenerator import ReportGenerator  # noqa: E402
+from RunHistory import RunHistory  # noqa: E402
+from main import host_context  # noqa: E402
+
+CLUSTER_KINDS = ("galera", "haproxy", "packetfence", "app")
+
+
+def write_inventory(base_path, env, hosts, clusters, cluster_size, max_unavailable, seed):
+    """Skriver <base_path>/<env>/inventory/hosts.ini och returnerar (antal standalone, antal klustervärdar)."""
+    rng = random.Random(seed)
+    inv_dir = os.path.join(base_path, env, "inventory")
+    os.makedirs(inv_dir, exist_ok=True)
+    members = min(hosts, clusters * cluster_size)
+    standalone = hosts - members
+
+    def host_line(name):
+        extra = ""
+        if rng.random() < 0.3:
+            extra += " freeipa_managed=true"
+        if rng.random() < 0.05:
+            extra += " autopatch=false"
+        octets = rng.randrange(1, 255), rng.randrange(1, 255)
+        return f"{name} ansible_host=10.{octets[0]}.{octets[1]}.{rng.randrange(1, 255)}{extra}\n"
+
+    with open(os.path.join(inv_dir, "hosts.ini"), "w", encoding="utf-8") as f:
+        f.write("[standalone]\n")
+        for i in range(standalone):
+            f.write(host_line(f"srv{i:05d}.sim"))
+        n = 0
+        for c in range(clusters):
+            size = cluster_size if c < clusters - 1 else members - n
+            if size <= 0:
+                break
+            name = f"{CLUSTER_KINDS[c % len(CLUSTER_KINDS)]}{c:04d}_cluster"
+            f.write(f"\n[{name}]\n")
+            for j in range(size):
+                f.write(host_line(f"{name[:-8]}-n{j:02d}.sim"))
+            if max_unavailable:
+                f.write(f"\n[{name}:vars]\nautopatch_max_unavailable={max_unavailable}\n")
+            n += size
+    return standalone, members
+
+
+class _Latency:
+    """Deterministisk latens och utfall per värd (oberoende av trådordning)."""
+
+    def __init__(self, args):
+        self.args = args
+
+    def rng(self, *key):
+        return random.Random(":".join(str(k) for k in (self.args.seed,) + key))
+
+    def sample_ms(self, rng, median_ms):
+        if median_ms <= 0:
+            return 0.0
+        return rng.lognormvariate(0, self.args.jitter) * median_ms
+
+    def probe(self, host, ip, user):
+        a = self.args
+        rng = self.rng("probe", host)
+        ping_ok = rng.random() >= a.ping_fail
+        ssh_ok = ping_ok and rng.random() >= a.ssh_fail
+        login_ok = (rng.random() >= a.login_fail) if ssh_ok else None
+        # Onåbara värdar kostar en timeout; övriga ping + tcp + ssh-login
+        delay_ms = a.probe_timeout_ms if not ssh_ok else self.sample_ms(rng, a.probe_ms)
+        return ProbeResult(host, ip, ping_ok, ssh_ok, login_ok, user), delay_ms * a.time_scale / 1000.0
+
+
+class SimHostProbe(HostProbe):
+    def __init__(self, latency, **kw):
+        super().__init__(**kw)
+        self.latency = latency
+
+    def probe(self, host, vars, ssh_user, ssh_pass):
+        res, delay = self.latency.probe(host, vars.get("ansible_host", host), ssh_user)
+        time.sleep(delay)
+        return res
+
+
+class SimAsyncHostProbe(AsyncHostProbe):
+    def __init__(self, latency, **kw):
+        super().__init__(**kw)
+        self.latency = latency
+
+    async def probe_async(self, host, vars, ssh_user, ssh_pass):
+        res, delay = self.latency.probe(host, vars.get("ansible_host", host), ssh_user)
+        await asyncio.sleep(delay)
+        return res
+
+
+class SimPlaybookExecutor(PlaybookExecutor):
+    def __init__(self, latency, inventory_path):
+        super().__init__(inventory_path)
+        self.latency = latency
+        self.calls = 0
+
+    def run_detailed(self, playbook_path, hosts, ssh_user, ssh_pass, dry_run=False, forks=None):
+        a = self.latency.args
+        hosts = list(hosts)
+        rng = self.latency.rng("patch", playbook_path, *hosts)
+        self.calls += 1
+        duration_ms = self.latency.sample_ms(rng, a.patch_base_ms) + a.patch_per_host_ms * len(hosts)
+        time.sleep(duration_ms * a.time_scale / 1000.0)
+        failed = [h for h in hosts if rng.random() < a.patch_fail]
+        task_dur = duration_ms / 1000.0 / max(1, a.tasks_per_host)
+        host_tasks = {
+            h: [{"task": f"task {t}", "action": "command", "status": "failed" if h in failed and t == 0 else "ok",
+                 "duration": round(task_dur, 3)} for t in range(a.tasks_per_host)]
+            for h in hosts
+        }
+        return PlaybookResult(ok=not failed, duration=duration_ms / 1000.0, failed_hosts=failed,
+                              rc=2 if failed else 0, host_tasks=host_tasks, finished_hosts=hosts)
+
+
+def peak_rss_mb():
+    # ru_maxrss är KiB på Linux, byte på macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def simulate(args):
+    latency = _Latency(args)
+    work = tempfile.mkdtemp(prefix="autopatch-sim-")
+    phases = []
+
+    def phase(name, started, items):
+        secs = time.perf_counter() - started
+        phases.append({"phase": name, "seconds": round(secs, 3), "items": items,
+                       "per_sec": round(items / secs, 1) if secs > 0 else None,
+                       "peak_rss_mb": round(peak_rss_mb(), 1)})
+
+    try:
+        clusters = args.clusters if args.clusters is not None else max(1, args.hosts // 50)
+        n_standalone, n_members = write_inventory(work, "sim", args.hosts, clusters, args.cluster_size,
+                                                  args.max_unavailable, args.seed)
+        cache_dir = os.path.join(work, "cache")
+        if args.inventory_cache:
+            AnsibleInventory(env="sim", base_path=work, cache_dir=cache_dir)
+
+        t = time.perf_counter()
+        inv = AnsibleInventory(env="sim", base_path=work, cache_dir=cache_dir, use_cache=args.inventory_cache)
+        standalone, groups = inv.standalone_hosts(), inv.cluster_groups()
+        phase("inventory", t, args.hosts)
+
+        if args.probe_engine == "async":
+            hp = SimAsyncHostProbe(latency, max_concurrency=args.max_concurrency)
+        else:
+            hp = SimHostProbe(latency)
+        pb = SimPlaybookExecutor(latency, inv.path)
+        helper = Helper(pb, health_probe=lambda d: hp.probe(d["host"], d["vars"], d["user"], d["password"]),
+                        health_timeout=0)
+
+        pipeline = None
+        if args.pipeline:
+            pipeline = PatchPipeline(helper, standalone, groups, dry_run=False, max_parallel=args.cluster_parallel)
+        scheduler = ProbeScheduler(hp, partial(host_context, inv), max_workers=args.max_workers,
+                                   on_result=pipeline.submit if pipeline else None)
+
+        t = time.perf_counter()
+        standalone_rows, cluster_rows = scheduler.run(standalone, groups)
+        phase("probe", t, args.hosts)
+
+        t = time.perf_counter()
+        if pipeline:
+            host_out, cluster_out = pipeline.wait()
+            standalone_outcomes = [host_out[d["host"]] for d in standalone_rows]
+            cluster_outcomes = [cluster_out[c] for c in cluster_rows]
+        else:
+            standalone_outcomes = helper.run_standalone(standalone_rows, dry_run=False,
+                                                        batch=args.standalone_batch)
+            cluster_outcomes = helper.run_clusters(cluster_rows, dry_run=False, max_parallel=args.cluster_parallel)
+        phase("patch (rest)" if pipeline else "patch", t, args.hosts)
+
+        t = time.perf_counter()
+        history = RunHistory(os.path.join(work, "history.db"))
+        try:
+            ReportGenerator(env="sim", run_id="sim", dry_run=False, reports_dir=os.path.join(work, "reports")).generate(
+                standalone_outcomes, cluster_outcomes, standalone_rows, cluster_rows,
+                xlsx=args.xlsx, history=history)
+        finally:
+            history.close()
+        phase("report", t, args.hosts)
+
+        total = sum(p["seconds"] for p in phases)
+        return {
+            "hosts": args.hosts,
+            "standalone": n_standalone,
+            "cluster_members": n_members,
+            "clusters": len(groups),
+            "playbook_runs": pb.calls,
+            "failed": sum(1 for o in standalone_outcomes if o.status == "FAILED")
+                      + sum(1 for o in cluster_outcomes if o.status == "FAILED"),
+            "phases": phases,
+            "total_seconds": round(total, 3),
+            "hosts_per_sec": round(args.hosts / total, 1) if total > 0 else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def print_result(r):
+    print(f"\n{r['hosts']} värdar ({r['standalone']} standalone, {r['clusters']} kluster / "
+          f"{r['cluster_members']} medlemmar), {r['playbook_runs']} playbook-körningar, {r['failed']} FAILED")
+    print(f"  {'fas':14} {'sek':>9} {'st/s':>10} {'peak RSS MB':>12}")
+    for p in r["phases"]:
+        print(f"  {p['phase']:14} {p['seconds']:9.3f} {p['per_sec'] or 0:10.1f} {p['peak_rss_mb']:12.1f}")
+    print(f"  {'totalt':14} {r['total_seconds']:9.3f} {r['hosts_per_sec'] or 0:10.1f} {r['peak_rss_mb']:12.1f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulerad flotta: overhead per fas utan nätverk")
+    parser.add_argument("--hosts", type=int, nargs="+", default=[100, 1000, 10000], help="flottstorlek(ar)")
+    parser.add_argument("--clusters", type=int, default=None, help="antal kluster (standard: hosts/50)")
+    parser.add_argument("--cluster-size", type=int, default=3)
+    parser.add_argument("--max-unavailable", default=None, help="autopatch_max_unavailable per kluster (vågor)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="skalar all simulerad latens (0 = mät bara autopatchs egen overhead)")
+    parser.add_argument("--jitter", type=float, default=0.5, help="sigma för lognormal latens")
+    parser.add_argument("--probe-ms", type=float, default=20, help="median probe-tid för nåbara värdar")
+    parser.add_argument("--probe-timeout-ms", type=float, default=500, help="probe-tid för onåbara värdar")
+    parser.add_argument("--ping-fail", type=float, default=0.02)
+    parser.add_argument("--ssh-fail", type=float, default=0.01)
+    parser.add_argument("--login-fail", type=float, default=0.01)
+    parser.add_argument("--patch-base-ms", type=float, default=50, help="median fast kostnad per playbook-körning")
+    parser.add_argument("--patch-per-host-ms", type=float, default=2)
+    parser.add_argument("--patch-fail", type=float, default=0.02, help="andel värdar som failar i playbooken")
+    parser.add_argument("--tasks-per-host", type=int, default=3, help="task-tider per värd i rapporten")
+    parser.add_argument("--probe-engine", choices=("thread", "async"), default="thread")
+    parser.add_argument("--max-workers", type=int, default=32)
+    parser.add_argument("--max-concurrency", type=int, default=256)
+    parser.add_argument("--standalone-batch", action="store_true")
+    parser.add_argument("--cluster-parallel", type=int, default=4)
+    parser.add_argument("--pipeline", action="store_true")
+    parser.add_argument("--inventory-cache", action="store_true", help="mät laddning från varm inventory-cache")
+    parser.add_argument("--xlsx", action="store_true", help="skapa även Excel-rapporten i rapportfasen")
+    parser.add_argument("--verbose", action="store_true", help="visa autopatchs loggning")
+    parser.add_argument("--json", metavar="PATH", help="skriv resultaten som JSON ('-' = stdout)")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    # Simulerade FAILED loggas annars som varningar per värd
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR, format="[%(levelname)s] %(message)s")
+    if len(args.hosts) == 1:
+        results = [simulate(argparse.Namespace(**{**vars(args), "hosts": args.hosts[0]}))]
+    else:
+        results = []
+        # Skicka vidare alla flaggor utom --hosts/--json och kör en storlek per process
+        child_args = _strip_option(_strip_option(sys.argv[1:], "--hosts", nargs="+"), "--json")
+        for n in args.hosts:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), *child_args,
+                                  "--hosts", str(n), "--json", "-"],
+                                 check=True, stdout=subprocess.PIPE, text=True).stdout
+            results.append(json.loads(out)[0])
+
+    if args.json == "-":
+        print(json.dumps(results))
+        return
+    for r in results:
+        print_result(r)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+def _strip_option(argv, name, nargs=None):
+    out, skip = [], False
+    for a in argv:
+        if skip:
+            skip = nargs == "+" and not a.startswith("-")
+            if skip or nargs is None:
+                continue
+        if a == name:
+            skip = True
+            continue
+        if a.startswith(name + "="):
+            continue
+        out.append(a)
+    return out
+
+
+if __name__ == "__main__":
+    main()
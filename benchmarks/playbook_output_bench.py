@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mikrobenchmarks för PlaybookExecutors hantering av ansible-utdata, med
+utdata från benchmarks/fake_ansible_playbook.py i olika batchstorlekar:
+
+  scanner      _OutputScanner.feed rad för rad (det som körs medan playbooken strömmar)
+  parse        _parse_failed_hosts(stdout, stderr) på hela utdatan
+  summary      _log_failure_summary med det scannern samlat (ska vara konstant)
+  run          run_detailed mot den fejkade ansible-playbook som subprocess
+               (strömning + spool + skanning), jämfört med att bara köra skriptet
+
+Failar om tid per rad växer mer än --max-ratio mellan minsta och största
+batchen (dvs. inte linjärt), om genomströmningen understiger --min-mbps,
+eller om de tolkade misslyckade värdarna skiljer sig från facit.
+
+    python benchmarks/playbook_output_bench.py
+    python benchmarks/playbook_output_bench.py --hosts 50 500 2000 --result-bytes 800 --no-run
+"""
+
+import argparse
+import io
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+
+import fake_ansible_playbook as fake  # noqa: E402
+from PlaybookExecutor import PlaybookExecutor, _OutputScanner  # noqa: E402
+
+FAKE = os.path.join(BENCH_DIR, "fake_ansible_playbook.py")
+
+
+def best_of(repeat, fn):
+    """Snabbaste av `repeat` körningar (sekunder) och sista returvärdet."""
+    best, result = float("inf"), None
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def fake_argv(args):
+    return ["--seed", str(args.seed), "--fail-rate", str(args.fail_rate),
+            "--unreachable-rate", str(args.unreachable_rate), "--ignore-rate", str(args.ignore_rate),
+            "--result-bytes", str(args.result_bytes)]
+
+
+def generate(hosts, args):
+    """(stdout, stderr, facit) för en batch, genererat i processen."""
+    out, err = io.StringIO(), io.StringIO()
+    _rc, expected = fake.emit(hosts, fake.parse_args(fake_argv(args)), out=out, err=err)
+    return out.getvalue(), err.getvalue(), expected
+
+
+def scan(stdout_lines):
+    scanner = _OutputScanner()
+    for line in stdout_lines:
+        scanner.feed(line)
+    return scanner
+
+
+def bench_size(n, args, pb, summary_log):
+    hosts = [f"srv{i:05d}.sim" for i in range(n)]
+    stdout, stderr, expected = generate(hosts, args)
+    lines = stdout.splitlines(keepends=True)
+    mb = len(stdout.encode("utf-8")) / 1e6
+    row = {"hosts": n, "lines": len(lines), "mb": mb, "expected": len(expected), "errors": []}
+
+    t, scanner = best_of(args.repeat, lambda: scan(lines))
+    row["scanner"] = t
+    if scanner.failed != expected:
+        row["errors"].append(f"scanner hittade {len(scanner.failed)} misslyckade, facit {len(expected)}")
+
+    t, failed = best_of(args.repeat, lambda: pb._parse_failed_hosts(stdout, stderr))
+    row["parse"] = t
+    if failed != expected:
+        row["errors"].append(f"_parse_failed_hosts hittade {len(failed)} misslyckade, facit {len(expected)}")
+
+    err_lines = [line.strip() for line in stderr.splitlines() if line.strip()][:20]
+    row["summary"], _ = best_of(args.repeat, lambda: pb._log_failure_summary(scanner.summary, err_lines))
+    summary_log.truncate(0)
+    summary_log.seek(0)
+
+    if args.run:
+        with tempfile.TemporaryDirectory(prefix="autopatch-bench-") as tmp:
+            inventory = os.path.join(tmp, "hosts.ini")
+            with open(inventory, "w", encoding="utf-8") as f:
+                f.write("\n".join(hosts) + "\n")
+            command = shlex.join([sys.executable, FAKE, *fake_argv(args)] + (["--events"] if args.events else []))
+            runner = PlaybookExecutor(inventory, ansible_playbook=command)
+            with open(os.devnull, "w") as devnull:
+                row["raw"], _ = best_of(args.repeat, lambda: subprocess.run(
+                    [*shlex.split(command), "-l", ",".join(hosts)], stdout=devnull, stderr=devnull))
+            row["run"], result = best_of(args.repeat, lambda: runner.run_detailed(
+                "patch.yml", hosts, "svc", "secret"))
+            if sorted(result.failed_hosts) != sorted(expected):
+                row["errors"].append(f"run_detailed gav {len(result.failed_hosts)} misslyckade, facit {len(expected)}")
+    return row
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark för tolkning av ansible-playbook-utdata")
+    parser.add_argument("--hosts", type=int, nargs="+", default=[50, 500, 2000], help="batchstorlekar")
+    parser.add_argument("--repeat", type=int, default=3, help="körningar per mätning (snabbaste rapporteras)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fail-rate", type=float, default=0.05)
+    parser.add_argument("--unreachable-rate", type=float, default=0.02)
+    parser.add_argument("--ignore-rate", type=float, default=0.1)
+    parser.add_argument("--result-bytes", type=int, default=400, help="modulresultat per rad (som -v)")
+    parser.add_argument("--max-ratio", type=float, default=2.0,
+                        help="max kvot mellan tid per rad i största och minsta batchen")
+    parser.add_argument("--min-mbps", type=float, default=20.0, help="min genomströmning för scanner/parse (MB/s)")
+    parser.add_argument("--max-summary-ms", type=float, default=5.0, help="max tid för _log_failure_summary")
+    parser.add_argument("--no-run", dest="run", action="store_false",
+                        help="hoppa över run_detailed mot den fejkade ansible-playbook")
+    parser.add_argument("--events", action="store_true",
+                        help="låt den fejkade ansible-playbook skriva autopatch_events (callback-vägen)")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    # Sammanfattningen loggas som vanligt men till en buffert, så att formateringen räknas
+    summary_log = io.StringIO()
+    handler = logging.StreamHandler(summary_log)
+    handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    logging.getLogger("PlaybookExecutor").addHandler(handler)
+    logging.getLogger("PlaybookExecutor").propagate = False
+    logging.getLogger("PlaybookExecutor").setLevel(logging.WARNING)
+
+    pb = PlaybookExecutor("/dev/null")
+    rows = [bench_size(n, args, pb, summary_log) for n in sorted(args.hosts)]
+
+    head = f"{'värdar':>7} {'rader':>8} {'MB':>7} {'fel':>5} {'scanner ms':>11} {'MB/s':>7} {'parse ms':>9} {'MB/s':>7} {'summary ms':>11}"
+    if args.run:
+        head += f" {'run s':>7} {'rå s':>7}"
+    print(head)
+    for r in rows:
+        line = (f"{r['hosts']:>7} {r['lines']:>8} {r['mb']:>7.2f} {r['expected']:>5} "
+                f"{r['scanner'] * 1000:>11.1f} {r['mb'] / r['scanner']:>7.1f} "
+                f"{r['parse'] * 1000:>9.1f} {r['mb'] / r['parse']:>7.1f} {r['summary'] * 1000:>11.3f}")
+        if args.run:
+            line += f" {r['run']:>7.2f} {r['raw']:>7.2f}"
+        print(line)
+
+    failed = False
+    for r in rows:
+        for error in r["errors"]:
+            print(f"FEL ({r['hosts']} värdar): {error}")
+            failed = True
+    small, large = rows[0], rows[-1]
+    for key in ("scanner", "parse"):
+        if large["hosts"] > small["hosts"]:
+            ratio = (large[key] / large["lines"]) / (small[key] / small["lines"])
+            print(f"{key}: tid per rad {ratio:.2f}x från {small['hosts']} till {large['hosts']} värdar")
+            if ratio > args.max_ratio:
+                print(f"FEL: {key} växer inte linjärt ({ratio:.2f}x > --max-ratio {args.max_ratio})")
+                failed = True
+        mbps = large["mb"] / large[key]
+        if mbps < args.min_mbps:
+            print(f"FEL: {key} {mbps:.1f} MB/s understiger --min-mbps {args.min_mbps}")
+            failed = True
+    worst = max(r["summary"] for r in rows) * 1000
+    if worst > args.max_summary_ms:
+        print(f"FEL: _log_failure_summary {worst:.2f} ms överstiger --max-summary-ms {args.max_summary_ms}")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
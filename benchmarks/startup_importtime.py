@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mäter uppstartstiden för autopatch-skripten med `python -X importtime` och
+failar om tunga beroenden (ansible, openpyxl, http.server) laddas vid start
+eller om den totala importtiden överstiger tröskeln.
+
+    python benchmarks/startup_importtime.py
+    python benchmarks/startup_importtime.py --max-ms 150 --runs 5
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (namn, argv) – --help räcker: allt som importeras på modulnivå laddas innan argparse avslutar
+ENTRY_POINTS = (
+    ("main", ["main.py", "--help"]),
+    ("inventory_summary", ["inventory_summary.py", "--help"]),
+)
+
+# Moduler som bara får laddas när de faktiskt används (inventory-bygge, rapport, daemon)
+FORBIDDEN = ("ansible", "openpyxl", "http.server")
+
+_LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)\s*$")
+
+
+def importtime(argv):
+    """Kör argv med -X importtime; returnerar {modul: kumulativ µs} för alla importer."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", *argv],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    modules = {}
+    for line in proc.stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if m:
+            modules[m.group(4)] = (int(m.group(2)), len(m.group(3)) // 2)
+    return modules
+
+
+def total_ms(modules) -> float:
+    # Toppnivåimporter (djup 0) summerar hela trädet under sig
+    return sum(cum for cum, depth in modules.values() if depth == 0) / 1000.0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark för uppstartstid (-X importtime)")
+    parser.add_argument("--runs", type=int, default=5, help="antal körningar per skript (median rapporteras)")
+    parser.add_argument("--max-ms", type=float, default=200.0, help="max median importtid (ms) per skript")
+    parser.add_argument("--top", type=int, default=10, help="visa de N dyraste toppnivåimporterna")
+    args = parser.parse_args()
+
+    failed = False
+    for name, argv in ENTRY_POINTS:
+        runs = [importtime(argv) for _ in range(max(1, args.runs))]
+        times = [total_ms(m) for m in runs]
+        median = statistics.median(times)
+        modules = runs[-1]
+
+        print(f"{name}: median {median:.1f} ms (min {min(times):.1f}, max {max(times):.1f}, {len(times)} körningar)")
+        top = sorted(((cum, mod) for mod, (cum, depth) in modules.items() if depth == 0), reverse=True)
+        for cum, mod in top[:args.top]:
+            print(f"  {cum / 1000.0:8.1f} ms  {mod}")
+
+        loaded = sorted(mod for mod in modules
+                        if any(mod == f or mod.startswith(f + ".") for f in FORBIDDEN))
+        if loaded:
+            print(f"  FEL: tunga moduler laddas vid start: {', '.join(loaded[:10])}")
+            failed = True
+        if median > args.max_ms:
+            print(f"  FEL: {median:.1f} ms överstiger --max-ms {args.max_ms:.1f}")
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Callback-plugin för autopatch: skriver en JSON-händelse per rad (JSONL) till
+# filen i AUTOPATCH_EVENTS_FILE. Aktiveras av PlaybookExecutor via
+# ANSIBLE_CALLBACK_PLUGINS + ANSIBLE_CALLBACKS_ENABLED; stdout-callbacken
+# (den vanliga textutdatan) påverkas inte.
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: autopatch_events
+    type: aggregate
+    short_description: JSON-händelser per värd och task med tidsåtgång
+    description:
+      - Skriver play-start (med playens sista task), task-start, resultat per värd
+        (med start/slut/duration) och recap som JSON Lines.
+    requirements:
+      - aktiveras i konfigurationen (callbacks_enabled)
+      - miljövariabeln AUTOPATCH_EVENTS_FILE
+'''
+
+import json
+import os
+import threading
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+META_ACTIONS = frozenset(('meta', 'ansible.builtin.meta', 'ansible.legacy.meta'))
+
+
+def _last_task(blocks):
+    """Sista vanliga task i blocken (rescue och meta-tasks räknas inte), eller None."""
+    last = None
+    for block in blocks:
+        for item in list(block.block) + list(block.always):
+            if hasattr(item, 'block'):
+                last = _last_task([item]) or last
+            elif item.action not in META_ACTIONS:
+                last = item
+    return last
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'autopatch_events'
+    CALLBACK_NEEDS_ENABLED = True
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        path = os.environ.get('AUTOPATCH_EVENTS_FILE')
+        self._fh = open(path, 'a', encoding='utf-8') if path else None
+        self._lock = threading.Lock()
+        self._host_starts = {}
+        self._task_starts = {}
+
+    def _emit(self, event):
+        if self._fh is None:
+            return
+        with self._lock:
+            self._fh.write(json.dumps(event, ensure_ascii=False) + '\n')
+            self._fh.flush()
+
+    def _task_started(self, task):
+        now = time.time()
+        self._task_starts[task._uuid] = now
+        self._emit({'event': 'task_start', 'task': task.get_name(), 'action': task.action, 'ts': now})
+
+    def v2_playbook_on_play_start(self, play):
+        # Playens sista task (som --list-tasks ser den): en värd som har ett
+        # resultat för den har gått igenom hela playen, även om andra värdar failade
+        try:
+            last = _last_task(play.compile())
+        except Exception:
+            last = None
+        self._emit({'event': 'play_start', 'play': play.get_name(),
+                    'last_task': last.get_name() if last is not None else None, 'ts': time.time()})
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._task_started(task)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._task_started(task)
+
+    def v2_runner_on_start(self, host, task):
+        self._host_starts[(host.get_name(), task._uuid)] = time.time()
+
+    def _host_result(self, result, status, ignore_errors=False):
+        host = result._host.get_name()
+        task = result._task
+        end = time.time()
+        start = self._host_starts.pop((host, task._uuid), None) or self._task_starts.get(task._uuid, end)
+        self._emit({
+            'event': 'host_task',
+            'host': host,
+            'task': task.get_name(),
+            'action': task.action,
+            'status': status,
+            'ignore_errors': bool(ignore_errors),
+            'start': start,
+            'end': end,
+            'duration': round(end - start, 3),
+        })
+
+    def v2_runner_on_ok(self, result):
+        self._host_result(result, 'changed' if result._result.get('changed') else 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._host_result(result, 'failed', ignore_errors=ignore_errors)
+
+    def v2_runner_on_unreachable(self, result):
+        self._host_result(result, 'unreachable')
+
+    def v2_runner_on_skipped(self, result):
+        self._host_result(result, 'skipped')
+
+    def v2_playbook_on_stats(self, stats):
+        hosts = {}
+        for h in sorted(stats.processed.keys()):
+            hosts[h] = stats.summarize(h)
+        self._emit({'event': 'stats', 'hosts': hosts, 'ts': time.time()})
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
@@ -3,37 +3,29 @@
 
 import argparse
 import json
+import os
 import sys
-from AnsibleInventory import AnsibleInventory
+import time
+from datetime import datetime
+from AnsibleInventory import AnsibleInventory, inventory_fingerprint
 
 
-def main() -> int:
-    parser = argparse.ArgumentParser(description='Summarize ansible inventory for dashboard use')
-    parser.add_argument('--env', required=True)
-    parser.add_argument('--base-path', default='../../../Ansible/environments')
-    args = parser.parse_args()
-
-    inventory = AnsibleInventory(env=args.env, base_path=args.base_path)
+def summarize(inventory: AnsibleInventory, env: str, base_path: str) -> dict:
     hosts = sorted(inventory.get_all_hosts())
     clusters = inventory.cluster_groups()
 
-    host_cluster = {}
-    for cluster_name, cluster_hosts in clusters.items():
-        for host in cluster_hosts:
-            host_cluster.setdefault(host, cluster_name)
-
     servers = [
         {
             'hostname': host,
-            'cluster': host_cluster.get(host, 'standalone'),
-            'env': args.env,
+            'cluster': inventory.cluster_of(host) or 'standalone',
+            'env': env,
         }
         for host in hosts
     ]
 
-    payload = {
-        'env': args.env,
-        'inventory_path': f"{args.base_path}/{args.env}/inventory",
+    return {
+        'env': env,
+        'inventory_path': f"{base_path}/{env}/inventory",
         'server_count': len(servers),
         'cluster_count': len(clusters),
         'servers': servers,
@@ -47,7 +39,117 @@ def main() -> int:
         ],
     }
 
-    print(json.dumps(payload, ensure_ascii=False))
+
+def discover_envs(base_path: str) -> list:
+    try:
+        names = sorted(os.listdir(base_path))
+    except OSError:
+        return []
+    return [n for n in names if os.path.exists(os.path.join(base_path, n, 'inventory'))]
+
+
+class SharedLoader:
+    """En DataLoader för alla miljöer i samma svep; importerar ansible först när den behövs."""
+
+    def __init__(self):
+        self._loader = None
+
+    def __call__(self):
+        if self._loader is None:
+            from ansible.parsing.dataloader import DataLoader
+            self._loader = DataLoader()
+        return self._loader
+
+
+def load_all(envs, args, loader_factory) -> dict:
+    out = {}
+    for env in envs:
+        inventory = AnsibleInventory(env=env, base_path=args.base_path, use_cache=not args.no_inventory_cache,
+                                     loader_factory=loader_factory)
+        out[env] = (inventory.fingerprint, summarize(inventory, env, args.base_path))
+    return out
+
+
+def render(envs, results, multi: bool) -> dict:
+    if not multi:
+        return results[envs[0]][1]
+    return {
+        'generated_at': datetime.utcnow().isoformat() + 'Z',
+        'envs': list(envs),
+        'environments': {env: results[env][1] for env in envs},
+    }
+
+
+def write_output(payload: dict, output: str) -> None:
+    if not output:
+        print(json.dumps(payload, ensure_ascii=False))
+        return
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{output}.tmp.{os.getpid()}"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp, output)
+
+
+def watch(envs, args, results, multi: bool) -> None:
+    """
+    Håller inventoryna laddade och skriver om sammanfattningen bara när någon källfil ändrats.
+    En miljö som inte går att läsa (t.ex. YAML-fel i group_vars) behåller sitt senaste
+    lyckade resultat och försöks igen först när filerna ändras på nytt.
+    """
+    broken = {}  # env -> fingerprint som senast misslyckades
+    while True:
+        time.sleep(args.interval)
+        current = {env: inventory_fingerprint(f"{args.base_path}/{env}/inventory") for env in envs}
+        changed = [env for env in envs if current[env] not in (results[env][0], broken.get(env))]
+        if not changed:
+            continue
+        # Ny DataLoader per omladdning: DataLoader cachar filinnehåll
+        loader = SharedLoader()
+        updated = []
+        for env in changed:
+            try:
+                results.update(load_all([env], args, loader))
+            except Exception as e:
+                broken[env] = current[env]
+                print(f"inventory_summary: kunde inte läsa {env}, behåller senaste resultatet: "
+                      f"{type(e).__name__}: {e}", file=sys.stderr)
+                continue
+            broken.pop(env, None)
+            updated.append(env)
+        if updated:
+            write_output(render(envs, results, multi), args.output)
+            print(f"inventory_summary: uppdaterade {','.join(updated)} -> {args.output}", file=sys.stderr)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Summarize ansible inventory for dashboard use')
+    parser.add_argument('--env', action='append', help='miljö; kan anges flera gånger')
+    parser.add_argument('--all', action='store_true', help='alla miljöer under --base-path')
+    parser.add_argument('--base-path', default='../../../Ansible/environments')
+    parser.add_argument('--no-inventory-cache', action='store_true')
+    parser.add_argument('--output', help='skriv JSON atomiskt till denna fil i stället för stdout')
+    parser.add_argument('--watch', action='store_true', help='skriv om --output när inventory-filer ändras')
+    parser.add_argument('--interval', type=float, default=5.0, help='sekunder mellan kontroller i --watch')
+    args = parser.parse_args()
+
+    envs = discover_envs(args.base_path) if args.all else list(dict.fromkeys(args.env or []))
+    if not envs:
+        parser.error('ange --env eller --all')
+    if args.watch and not args.output:
+        parser.error('--watch kräver --output')
+
+    multi = args.all or len(envs) > 1
+    results = load_all(envs, args, SharedLoader())
+    write_output(render(envs, results, multi), args.output)
+
+    if args.watch:
+        try:
+            watch(envs, args, results, multi)
+        except KeyboardInterrupt:
+            pass
     return 0
 
 
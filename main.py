@@ -3,16 +3,29 @@
 
 import argparse
 import logging
+import os
+import re
+import shutil
+import sqlite3
+import sys
 from logging.handlers import RotatingFileHandler
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import partial
 
-from AnsibleInventory import AnsibleInventory
-from HostProbe import HostProbe
+from AnsibleInventory import AnsibleInventory, inventory_fingerprint
+from HostProbe import HostProbe, AsyncHostProbe
+from Metrics import MetricsRegistry
 from PlaybookExecutor import PlaybookExecutor
-from Helper import Helper
+from ProbeScheduler import ProbeScheduler
+from PatchOrder import DurationEstimator, longest_first
+from ProbeCache import ProbeCache
+from RunHistory import RunHistory
+from RunJournal import RunJournal
+from SshControlMaster import SshControlMaster
+from Helper import Helper, PatchPipeline
 
-from ReportGenerator import ReportGenerator
+# ReportGenerator (openpyxl) och AutopatchDaemon (http.server) importeras först där de används,
+# så att --help, --probe-only och felaktiga argument inte betalar för dem
 
 IPA_USER = "KONTO"
 IPA_PASS = "standard"
@@ -46,23 +59,28 @@ def is_autopatch_enabled(vars_dict):
     return val not in ("false", "no", "0")
 
 
-def probe_host(inv, hp, host):
+def host_context(inv, host):
     vars = inv.get_host_vars(host)
     freeipa = bool(vars.get("freeipa_managed"))
-    user = IPA_USER if freeipa else DEFAULT_USER
-    pw = IPA_PASS if freeipa else DEFAULT_PASS
-    res = hp.probe(host, vars, user, pw)
     return {
         "host": host,
         "vars": vars,
         "freeipa": freeipa,
-        "user": user,
-        "password": pw,
-        "result": res,
+        "user": IPA_USER if freeipa else DEFAULT_USER,
+        "password": IPA_PASS if freeipa else DEFAULT_PASS,
+        "result": None,
         "autopatch_enabled": is_autopatch_enabled(vars),
     }
 
 
+def log_playbook_progress(ev):
+    plog = logging.getLogger("patch")
+    if ev.failed_host:
+        plog.warning(f"{ev.failed_host} misslyckades i task '{ev.task}' (hosts={','.join(ev.hosts)})")
+    else:
+        plog.debug(f"hosts={','.join(ev.hosts)} task='{ev.task}' rad={ev.line_no}")
+
+
 def cluster_status(member_dicts):
     for d in member_dicts:
         if not d["autopatch_enabled"]:
@@ -89,60 +107,378 @@ def print_table(title, rows, width=98, no_color=False):
     print("".ljust(width, "─"))
 
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(prog="Main.py", description="Autopatch probe + patch runner")
     parser.add_argument("--env", default="qa", help="miljö (t.ex. qa, prod)")
     parser.add_argument("--base-path", default="../../../Ansible/environments", help="bas-sökväg till environments")
     parser.add_argument("--dry-run", action="store_true", help="kör ansible-playbooks i --check-läge")
-    parser.add_argument("--max-workers", type=int, default=2, help="antal trådar för probe")
+    parser.add_argument("--probe-only", action="store_true",
+                        help="proba och skriv ut tabellerna, men patcha inte och skapa ingen rapport")
+    parser.add_argument("--no-inventory-cache", action="store_true",
+                        help="läs alltid inventoryt via ansible i stället för den kompilerade cachen")
+    parser.add_argument("--max-workers", type=int, default=2, help="antal trådar för probe (en gemensam kö för hela flottan)")
     parser.add_argument("--probe-timeout", type=float, default=5, help="timeout för ping/ssh (sek)")
+    parser.add_argument("--probe-engine", choices=("thread", "async"), default="thread",
+                        help="thread = ThreadPoolExecutor, async = asyncio (AsyncHostProbe)")
+    parser.add_argument("--max-concurrency", type=int, default=256,
+                        help="max samtidiga prober för --probe-engine async")
+    parser.add_argument("--ping-backend", choices=("subprocess", "batch"), default="subprocess",
+                        help="subprocess = en ping-process per värd, batch = alla värdar i ett svep (ICMP/fping)")
+    parser.add_argument("--probe-cache", metavar="PATH",
+                        help="återanvänd färska probe-resultat från denna cachefil (JSON)")
+    parser.add_argument("--max-probe-age", type=float, default=600,
+                        help="max ålder (sek) för ett friskt cachat probe-resultat")
+    parser.add_argument("--max-failed-probe-age", type=float, default=0,
+                        help="max ålder (sek) för ett misslyckat cachat probe-resultat (0 = proba alltid om)")
+    parser.add_argument("--ssh-control-master", action="store_true",
+                        help="dela SSH ControlMaster-sessioner mellan probe och ansible-playbook")
+    parser.add_argument("--ssh-control-persist", type=int, default=900,
+                        help="ControlPersist (sek) för --ssh-control-master")
+    parser.add_argument("--standalone-batch", action="store_true",
+                        help="patcha standalone-värdar i en ansible-playbook-körning per (user, password)")
+    parser.add_argument("--forks", type=int, default=None,
+                        help="ansible --forks för --standalone-batch")
+    parser.add_argument("--cluster-parallel", type=int, default=1,
+                        help="antal kluster som patchas samtidigt")
+    parser.add_argument("--cluster-parallel-per-playbook", type=int, default=None,
+                        help="max samtidiga kluster per playbook-typ")
+    parser.add_argument("--wave-health-timeout", type=float, default=300,
+                        help="max väntan (sek) på att en klustervåg är frisk igen innan nästa våg startar")
+    parser.add_argument("--wave-health-interval", type=float, default=5,
+                        help="sekunder mellan hälsokontroller av en klustervåg")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="börja patcha medan probningen pågår: en värd/ett kluster så fort dess probe är klar")
+    parser.add_argument("--patch-order", choices=("inventory", "longest-first"), default="longest-first",
+                        help="ordning för patchjobben: inventory = namnordning, "
+                             "longest-first = längst förväntad tid (från tidigare körningar) först")
+    parser.add_argument("--default-duration", type=float, default=None,
+                        help="förväntad patchtid (sek) för värdar/kluster utan historik (standard: medianen av kända)")
+    parser.add_argument("--xlsx", action="store_true",
+                        help="skapa Excel-rapporten direkt vid körningens slut (annars: main.py render-xlsx RUN_ID)")
+    parser.add_argument("--history-db", default="reports/autopatch_history.db",
+                        help="SQLite-databas för körhistorik (tom sträng = ingen historik)")
+    parser.add_argument("--journal-dir", default="reports/journal",
+                        help="katalog för körjournaler (tom sträng = ingen journal)")
+    parser.add_argument("--resume", metavar="RUN_ID",
+                        help="återuppta en avbruten körning från dess journal; klara värdar/kluster hoppas över")
+    parser.add_argument("--playbook-output-dir", default="",
+                        help="spara ansible-playbook-utdata (stdout/stderr/händelser) per körning i denna katalog "
+                             "(standard: temporära filer, bara sammanfattningen hamnar i loggen)")
+    parser.add_argument("--playbook-output-keep", type=int, default=20,
+                        help="antal körningar vars utdata behålls i --playbook-output-dir (0 = alla)")
+    parser.add_argument("--metrics-file",
+                        help="skriv mätvärden (probe-/playbook-/fastider, utfall) i Prometheus textformat hit "
+                             "efter varje körning, t.ex. till node_exporters textfile-katalog (*.prom)")
     parser.add_argument("--no-color", action="store_true", help="ingen färg i statusutskrifter")
     parser.add_argument("--log-file", default="autopatch.log", help="sökväg till loggfil")
-    args = parser.parse_args()
+    parser.add_argument("--daemon", metavar="LISTEN",
+                        help="kör som daemon med jobbkö; LISTEN = host:port eller unix:/sökväg")
+    return parser
+
+
+def parse_args(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.resume and not args.journal_dir:
+        parser.error("--resume kräver --journal-dir")
+    if args.resume:
+        try:
+            resume_state(args)
+        except (OSError, ValueError) as e:
+            parser.exit(1, f"{parser.prog}: --resume: {e}\n")
+    return args
+
+
+def render_command(argv):
+    parser = argparse.ArgumentParser(prog="Main.py render-xlsx",
+                                     description="Skapa Excel-rapporten för en körning från dess rapportfil")
+    parser.add_argument("run_id", help="körningens run_id (t.ex. 20240101-120000)")
+    parser.add_argument("--env", help="miljö, om flera miljöer har samma run_id")
+    parser.add_argument("--reports-dir", default="reports", help="katalog med rapporterna")
+    parser.add_argument("--force", action="store_true", help="rendera om även om xlsx redan finns")
+    args = parser.parse_args(argv)
+
+    from ReportGenerator import render_xlsx
+
+    try:
+        path = render_xlsx(args.run_id, env=args.env, reports_dir=args.reports_dir, force=args.force)
+    except (OSError, ValueError) as e:
+        parser.exit(1, f"render-xlsx: {e}\n")
+    print(path)
+
+
+def main():
+    if sys.argv[1:2] == ["render-xlsx"]:
+        render_command(sys.argv[2:])
+        return
 
+    args = parse_args()
     setup_logging(args.log_file)
-    log = logging.getLogger("Main")
 
-    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
-    log.info(f"=== Autopatch run start [{run_id}] env={args.env} dry_run={args.dry_run} ===")
+    if args.daemon:
+        serve(args)
+        return
+
+    ssh_control = SshControlMaster(persist=args.ssh_control_persist) if args.ssh_control_master else None
+    try:
+        run(args, ssh_control, probe_only=args.probe_only)
+    finally:
+        if ssh_control:
+            ssh_control.close()
+
+
+def build_probe(args, ssh_control=None):
+    if args.probe_engine == "async":
+        return AsyncHostProbe(timeout=args.probe_timeout, max_concurrency=args.max_concurrency,
+                              ping_backend=args.ping_backend, control=ssh_control)
+    return HostProbe(timeout=args.probe_timeout, ping_backend=args.ping_backend, control=ssh_control)
+
+
+# Argument som inte får skrivas över från ett daemon-jobb (bl.a. alla sökvägar)
+DAEMON_FIXED_ARGS = ("daemon", "log_file", "base_path", "metrics_file", "history_db", "journal_dir",
+                     "probe_cache", "playbook_output_dir", "playbook_output_keep")
+
+
+def job_value(action, value):
+    """
+    Tolkar ett JSON-värde för ett daemon-jobb som argparse skulle ha tolkat
+    motsvarande flagga: flaggor måste vara riktiga bool, övriga går genom
+    action.type och choices. ValueError vid ogiltigt värde.
+    """
+    name = action.option_strings[0]
+    if action.nargs == 0:
+        if not isinstance(value, bool):
+            raise ValueError(f"{name} måste vara true eller false, inte {value!r}")
+        return value if action.const is True else not value
+    if value is None and action.default is None:
+        return None
+    if isinstance(value, (bool, list, dict)) or value is None:
+        raise ValueError(f"ogiltigt värde för {name}: {value!r}")
+    try:
+        value = action.type(value) if action.type else str(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"ogiltigt värde för {name}: {value!r}")
+    if action.choices is not None and value not in action.choices:
+        raise ValueError(f"ogiltigt värde för {name}: {value!r} (välj bland {', '.join(action.choices)})")
+    return value
+
+
+def serve(args):
+    """Daemon-läge: håller inventory, HostProbe och PlaybookExecutor varma mellan jobben."""
+    log = logging.getLogger("Daemon")
+    warm_inv = {}
+    warm_pb = {}
+    warm_hp = {}
+    # Ackumuleras över jobben och exponeras på GET /metrics
+    metrics = MetricsRegistry()
+
+    actions = {a.dest: a for a in build_parser()._actions if a.option_strings and a.dest != "help"}
+
+    def job_args(job):
+        values = dict(vars(args))
+        for key, value in job.params.items():
+            key = key.replace("-", "_")
+            if key not in values or key not in actions or key in DAEMON_FIXED_ARGS:
+                raise ValueError(f"okänd eller låst parameter: {key}")
+            values[key] = job_value(actions[key], value)
+        if not re.match(r"^[\w.-]+$", job.env):
+            raise ValueError(f"ogiltig env: {job.env!r}")
+        if values["resume"] is not None and not re.match(r"^[\w.-]+$", values["resume"]):
+            raise ValueError(f"ogiltigt run_id för resume: {values['resume']!r}")
+        values["env"] = job.env
+        return argparse.Namespace(**values)
+
+    def inventory_for(a):
+        inv = warm_inv.get(a.env)
+        if inv is None or inventory_fingerprint(inv.path) != inv.fingerprint:
+            inv = AnsibleInventory(env=a.env, base_path=a.base_path, use_cache=not a.no_inventory_cache)
+            warm_inv[a.env] = inv
+            warm_pb[a.env] = PlaybookExecutor(inv.path, progress=log_playbook_progress)
+        return inv, warm_pb[a.env]
+
+    def execute(job):
+        # Jobben körs ett i taget av daemonens worker-tråd
+        a = job_args(job)
+        inv, pb = inventory_for(a)
+        ssh_control = SshControlMaster(persist=a.ssh_control_persist) if a.ssh_control_master else None
+        if ssh_control:
+            hp = build_probe(a, ssh_control)
+        else:
+            key = (a.probe_engine, a.probe_timeout, a.max_concurrency, a.ping_backend)
+            if key not in warm_hp:
+                warm_hp[key] = build_probe(a)
+            hp = warm_hp[key]
+        pb.ssh_control = ssh_control
+        try:
+            return run(a, ssh_control, inv=inv, hp=hp, pb=pb, probe_only=job.type == "probe" or a.probe_only,
+                       metrics=metrics, run_id=job.id)
+        finally:
+            if ssh_control:
+                ssh_control.close()
+
+    from AutopatchDaemon import AutopatchDaemon
+    from ReportGenerator import render_xlsx
+
+    log.info(f"Startar autopatch daemon på {args.daemon}")
+    AutopatchDaemon(execute, args.daemon, validate=job_args, render=render_xlsx,
+                    metrics=metrics.render).serve_forever()
+
+
+def prune_playbook_output(directory, keep, run_id):
+    """Tar bort utdata från de äldsta körningarna så att högst `keep` (inkl. denna) finns kvar."""
+    if keep <= 0 or not os.path.isdir(directory):
+        return
+    runs = sorted(d for d in os.listdir(directory)
+                  if d != run_id and re.match(r"^\d{8}-\d{6}(-\d+)?$", d) and os.path.isdir(os.path.join(directory, d)))
+    for old in runs[:max(0, len(runs) - (keep - 1))]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+        logging.getLogger("Main").debug(f"Tog bort gammal playbook-utdata {old}")
+
+
+def fan_out(*callbacks):
+    callbacks = [cb for cb in callbacks if cb]
+    if not callbacks:
+        return None
+
+    def call(row):
+        for cb in callbacks:
+            cb(row)
+    return call
 
-    inv = AnsibleInventory(env=args.env, base_path=args.base_path)
-    hp = HostProbe(timeout=args.probe_timeout)
-    pb = PlaybookExecutor(inv.path)
-    helper = Helper(pb)
 
-    clusters = inv.cluster_groups()
-    standalone = inv.standalone_hosts()
+def load_estimator(args):
+    if args.history_db and os.path.exists(args.history_db):
+        with RunHistory(args.history_db) as history:
+            est = DurationEstimator.from_history(history, args.env, default=args.default_duration)
+    else:
+        est = DurationEstimator.from_reports("reports", args.env, default=args.default_duration)
+    logging.getLogger("Main").info(
+        f"Patchordning longest-first: historik för {len(est.hosts)} värdar och {len(est.clusters)} kluster, "
+        f"okända räknas som {est.default:.0f}s"
+    )
+    return est
+
+
+def resume_state(args):
+    """Journalen för --resume; ValueError (eller OSError) om körningen inte kan återupptas med args."""
+    state = RunJournal.replay(RunJournal.path_for(args.journal_dir, args.resume))
+    if state.start.get("env", args.env) != args.env:
+        raise ValueError(f"körning {args.resume} gällde env={state.start['env']}, inte {args.env}")
+    if bool(state.start.get("dry_run", args.dry_run)) != bool(args.dry_run):
+        # Annars rapporteras värdar som aldrig patchades som OK (eller tvärtom)
+        flag = "med" if state.start["dry_run"] else "utan"
+        raise ValueError(f"körning {args.resume} startades {flag} --dry-run; återuppta den likadant")
+    if state.finished:
+        raise ValueError(f"körning {args.resume} är redan avslutad och kan inte återupptas")
+    return state
+
+
+def run(args, ssh_control=None, inv=None, hp=None, pb=None, probe_only=False, metrics=None, run_id=None):
+    started = datetime.now()
+    # Daemonen skickar jobbets id: jobb som startar samma sekund får annars samma run_id
+    run_id = run_id or started.strftime("%Y%m%d-%H%M%S")
+    started_at = datetime.utcfromtimestamp(started.timestamp()).isoformat() + "Z"
+
+    state = None
+    if args.resume:
+        state = resume_state(args)
+        run_id = args.resume
+        started_at = state.start.get("started_at") or started_at
+
+    if metrics is None:
+        metrics = MetricsRegistry()
+    journal = RunJournal(RunJournal.path_for(args.journal_dir, run_id)) if args.journal_dir else None
+    try:
+        if journal:
+            journal.start(run_id, args.env, args.dry_run, started_at, resumed=state is not None)
+        return _run(args, run_id, started_at, ssh_control, inv, hp, pb, probe_only, journal, state,
+                    metrics.for_env(args.env))
+    finally:
+        if journal:
+            journal.close()
+        if args.metrics_file:
+            # Även en avbruten körning lämnar sina prob- och playbooktider efter sig
+            try:
+                metrics.write_textfile(args.metrics_file)
+            except OSError as e:
+                logging.getLogger("Main").warning(f"Kunde inte skriva metrics till {args.metrics_file}: {e}")
+
+
+def _run(args, run_id, started_at, ssh_control, inv, hp, pb, probe_only, journal, state, metrics):
+    log = logging.getLogger("Main")
+    resumed = " (återupptagen)" if state else ""
+    log.info(f"=== Autopatch run start [{run_id}]{resumed} env={args.env} dry_run={args.dry_run} ===")
+    if state:
+        log.info(f"Journal {run_id}: {len(state.probes)} prober, {len(state.standalone)} standalone och "
+                 f"{len(state.clusters)} kluster redan klara")
+
+    with metrics.phase("inventory"):
+        if inv is None:
+            inv = AnsibleInventory(env=args.env, base_path=args.base_path, use_cache=not args.no_inventory_cache)
+        clusters = inv.cluster_groups()
+        standalone = inv.standalone_hosts()
+    if hp is None:
+        hp = build_probe(args, ssh_control)
+    if pb is None:
+        pb = PlaybookExecutor(inv.path, ssh_control=ssh_control, progress=log_playbook_progress)
+    hp.metrics = pb.metrics = metrics
+    pb.spool_dir = None
+    if args.playbook_output_dir:
+        prune_playbook_output(args.playbook_output_dir, args.playbook_output_keep, run_id)
+        pb.spool_dir = os.path.join(args.playbook_output_dir, run_id)
+        if state:
+            # Skriv inte över utdata från det avbrutna försöket
+            pb.spool_dir = os.path.join(pb.spool_dir, f"resume-{datetime.now():%Y%m%d-%H%M%S}")
+    recheck = hp.for_recheck()
+    helper = Helper(pb, on_outcome=journal.outcome if journal else None,
+                    health_probe=lambda d: recheck.probe(d["host"], d["vars"], d["user"], d["password"]),
+                    health_timeout=args.wave_health_timeout, health_interval=args.wave_health_interval)
+
     log.info(f"Inventory loaded: {len(standalone)} standalone, {len(clusters)} clusters")
 
-    log.info("Probing standalone hosts...")
-    standalone_rows = []
-    with ThreadPoolExecutor(max_workers=args.max_workers) as ex:
-        futs = {ex.submit(probe_host, inv, hp, h): h for h in standalone}
-        for f in as_completed(futs):
-            d = f.result()
+    estimator = None
+    if not probe_only and args.patch_order == "longest-first":
+        estimator = load_estimator(args)
+    done_hosts = state.standalone if state else {}
+    done_clusters = state.clusters if state else {}
+
+    pipeline = None
+    if args.pipeline and not probe_only:
+        if args.standalone_batch:
+            log.warning("--standalone-batch används inte med --pipeline: standalone-värdar patchas en och en")
+        pipeline = PatchPipeline(helper, standalone, clusters, dry_run=args.dry_run,
+                                 max_parallel=args.cluster_parallel,
+                                 per_playbook=args.cluster_parallel_per_playbook,
+                                 skip_hosts=done_hosts, skip_clusters=done_clusters,
+                                 host_priority=estimator.host if estimator else None,
+                                 cluster_priority=estimator.cluster if estimator else None)
+
+    log.info("Probing standalone hosts and cluster members...")
+    cache = None
+    if args.probe_cache:
+        cache = ProbeCache(args.probe_cache, ttl_ok=args.max_probe_age, ttl_failed=args.max_failed_probe_age)
+    scheduler = ProbeScheduler(hp, partial(host_context, inv), max_workers=args.max_workers, cache=cache,
+                               on_result=fan_out(journal.probe if journal else None,
+                                                 pipeline.submit if pipeline else None))
+    with metrics.phase("probe"):
+        standalone_rows, cluster_rows = scheduler.run(standalone, clusters, known=state.probes if state else None)
+    if journal:
+        journal.sync()
+    if pipeline:
+        # Resultat ur journalen (--resume) går inte via on_result
+        for d in standalone_rows + [d for rows in cluster_rows.values() for d in rows]:
+            pipeline.submit(d)
+    for d in standalone_rows:
+        r = d["result"]
+        logging.getLogger("probe").debug(
+            f"standalone {r.host} ping={r.ping_ok} ssh={r.ssh_ok} login={r.ssh_login_ok} user={r.used_user}"
+        )
+    for cname, rows in cluster_rows.items():
+        for d in rows:
             r = d["result"]
             logging.getLogger("probe").debug(
-                f"standalone {r.host} ping={r.ping_ok} ssh={r.ssh_ok} login={r.ssh_login_ok} user={r.used_user}"
+                f"{cname} {r.host} ping={r.ping_ok} ssh={r.ssh_ok} login={r.ssh_login_ok} user={r.used_user}"
             )
-            standalone_rows.append(d)
-    standalone_rows.sort(key=lambda x: x["result"].host)
-
-    log.info("Probing cluster members...")
-    cluster_rows = {}
-    for cname, members in clusters.items():
-        rows = []
-        with ThreadPoolExecutor(max_workers=args.max_workers) as ex:
-            futs = {ex.submit(probe_host, inv, hp, h): h for h in members}
-            for f in as_completed(futs):
-                d = f.result()
-                r = d["result"]
-                logging.getLogger("probe").debug(
-                    f"{cname} {r.host} ping={r.ping_ok} ssh={r.ssh_ok} login={r.ssh_login_ok} user={r.used_user}"
-                )
-                rows.append(d)
-        rows.sort(key=lambda x: x["result"].host)
-        cluster_rows[cname] = rows
 
     print("\n" + "=" * 30)
     print(" STANDALONE SERVRAR (probe) ")
@@ -165,10 +501,35 @@ def main():
             print(f"\n{cname} -> {tag}")
             print_table(cname, rows, no_color=args.no_color)
 
+    if probe_only:
+        if journal:
+            journal.finish()
+        log.info(f"=== Autopatch probe end [{run_id}] ===")
+        return {
+            "run_id": run_id,
+            "env": args.env,
+            "probe_only": True,
+            "standalone": {"probed": len(standalone_rows)},
+            "clusters": {cname: cluster_status(rows) for cname, rows in cluster_rows.items()},
+        }
+
     print("\n" + "=" * 30)
     print(f" STANDALONE PATCH (dry-run={args.dry_run}) ")
     print("=" * 30)
-    standalone_outcomes = helper.run_standalone(standalone_rows, dry_run=args.dry_run)
+    if pipeline:
+        # Patchningen överlappar probe-fasen; "patch" är resten efter att proberna är klara
+        with metrics.phase("patch"):
+            fresh_hosts, fresh_clusters = pipeline.wait()
+    else:
+        todo_rows = [d for d in standalone_rows if d["host"] not in done_hosts]
+        if estimator:
+            todo_rows = longest_first(todo_rows, lambda d: estimator.host(d["host"]), name=lambda d: d["host"])
+        with metrics.phase("standalone"):
+            fresh = helper.run_standalone(todo_rows, dry_run=args.dry_run,
+                                          batch=args.standalone_batch, forks=args.forks)
+        fresh_hosts = {o.host: o for o in fresh}
+    by_host = {**done_hosts, **fresh_hosts}
+    standalone_outcomes = [by_host[d["host"]] for d in standalone_rows]
     for o in standalone_outcomes:
         logging.getLogger("patch").info(
             f"standalone {o.host} -> {o.status} ({o.duration:.1f}s) reason={o.reason} "
@@ -180,10 +541,19 @@ def main():
     print("\n" + "=" * 30)
     print(f" KLUSTER PATCH (dry-run={args.dry_run}) ")
     print("=" * 30)
-    cluster_outcomes = []
-    for cname, rows in cluster_rows.items():
-        co = helper.run_cluster(cname, rows, dry_run=args.dry_run)
-        cluster_outcomes.append(co)
+    if not pipeline:
+        todo_clusters = [c for c in cluster_rows if c not in done_clusters]
+        if estimator:
+            todo_clusters = longest_first(todo_clusters, estimator.cluster)
+        with metrics.phase("clusters"):
+            fresh = helper.run_clusters({c: cluster_rows[c] for c in todo_clusters},
+                                        dry_run=args.dry_run, max_parallel=args.cluster_parallel,
+                                        per_playbook=args.cluster_parallel_per_playbook)
+        fresh_clusters = {co.cluster: co for co in fresh}
+    by_cluster = {**done_clusters, **fresh_clusters}
+    cluster_outcomes = [by_cluster[c] for c in cluster_rows]
+    for co in cluster_outcomes:
+        cname = co.cluster
         logging.getLogger("patch").info(
             f"cluster {cname} -> {co.status} ({co.duration_total:.1f}s) reason={co.reason} "
             f"{'failed_hosts='+','.join(co.failed_hosts) if co.failed_hosts else ''}"
@@ -209,6 +579,8 @@ def main():
 
     s_ok, s_fail, s_skip = _count_status(standalone_outcomes)
     c_ok, c_fail, c_skip = _count_status(cluster_outcomes)
+    metrics.count_outcomes("standalone", standalone_outcomes)
+    metrics.count_outcomes("cluster", cluster_outcomes)
 
     print("\n" + "=" * 30)
     print(" SAMMANFATTNING ")
@@ -239,6 +611,7 @@ def main():
 
     log.info(f"=== Autopatch run end [{run_id}] ===")
 
+    from ReportGenerator import ReportGenerator
 
     rep = ReportGenerator(
         env=args.env,
@@ -246,15 +619,44 @@ def main():
         dry_run=args.dry_run
     )
 
-    report_file = rep.generate(
-        standalone_outcomes=standalone_outcomes,
-        cluster_outcomes=cluster_outcomes,
-        standalone_probe=standalone_rows,
-        cluster_probe=cluster_rows
-    )
+    history = None
+    if args.history_db:
+        try:
+            history = RunHistory(args.history_db)
+        except (sqlite3.Error, OSError) as e:
+            log.warning(f"Kunde inte öppna körhistorik {args.history_db}: {e}")
+    try:
+        with metrics.phase("report"):
+            report_files = rep.generate(
+                standalone_outcomes=standalone_outcomes,
+                cluster_outcomes=cluster_outcomes,
+                standalone_probe=standalone_rows,
+                cluster_probe=cluster_rows,
+                xlsx=args.xlsx,
+                started_at=started_at,
+                history=history,
+            )
+    finally:
+        if history:
+            history.close()
+    # Först när rapporten finns: en krasch innan dess ska gå att återuppta med --resume
+    if journal:
+        journal.finish()
+    metrics.run_finished()
+
+    print(f"\nRapport skapad: {', '.join(report_files)}")
+    if not args.xlsx:
+        print(f"Excel-rapport: python main.py render-xlsx {run_id} --env {args.env}")
+    logging.getLogger("Main").info(f"Report written: {report_files}")
 
-    print(f"\nExcel-rapport skapad: {report_file}")
-    logging.getLogger("Main").info(f"Excel report written: {report_file}")
+    return {
+        "run_id": run_id,
+        "env": args.env,
+        "dry_run": args.dry_run,
+        "standalone": {"ok": s_ok, "failed": s_fail, "skipped": s_skip},
+        "clusters": {"ok": c_ok, "failed": c_fail, "skipped": c_skip},
+        "report": report_files,
+    }
 
 
 if __name__ == "__main__":